@@ -2,28 +2,31 @@ import os
 from contextlib import asynccontextmanager
 import datetime
 import random
-from typing import List
+from typing import List, Optional
 from uuid import uuid4
 
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, JSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import APIRouter, Depends, FastAPI, HTTPException, UploadFile, File, Request, Response, Query, WebSocket, WebSocketDisconnect
 from fastapi.staticfiles import StaticFiles
 from sqlalchemy import select
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import noload
 from starlette import status
 from starlette.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware
 from starlette.config import Config
 from starlette.responses import RedirectResponse
 import shutil
-from pydub import AudioSegment
-from db import User, create_db_and_tables, get_async_session
-from models import CalendarEvent, KanbanCard, KanbanColumn, SoundFileModel, PhoneListModel, CompanyModel
-from schemas import CalendarEventCreate, KanbanCardCreate, KanbanCardResponse, KanbanColumnCreate, KanbanColumnResponse, UserCreate, UserRead, UserUpdate, SoundFile, SoundFileCreate, PhoneList, PhoneListCreate, \
-    CompanyCreate, Company, CallFile, CreateEventRequest
-from users import auth_backend, current_active_user, fastapi_users, google_oauth_client, openid_oauth_client, SECRET, get_all_users, create_user_pro, \
-    create_phone_list_pro, create_sound_file_pro, create_company_pro
+import hashlib
+import traceback
+import tempfile
+from db import User, async_session_maker, create_db_and_tables, get_async_session, release_connection
+from models import CalendarEvent, KanbanCard, KanbanColumn, SoundFileModel, PhoneListModel, CompanyModel, CampaignModel
+from schemas import CalendarEventCreate, KanbanCardCreate, KanbanCardResponse, KanbanColumnCreate, KanbanColumnResponse, UserCreate, UserRead, UserUpdate, SoundFile, SoundFileUpdate, PhoneList, PhoneListCreate, \
+    CompanyCreate, Company, CallFile, CreateEventRequest, Campaign, CampaignStats, PhoneNumbers, PhoneNumberPage, JobStatus, \
+    SoundFileUpload
+from users import auth_backend, current_active_user, current_token_user_id, fastapi_users, google_oauth_client, openid_oauth_client, SECRET, get_all_users, create_user_pro, \
+    create_phone_list_pro, create_sound_file_pro, create_company_pro, get_user_from_token
 
 from fastapi_users.router.common import ErrorCode
 from fastapi_users.exceptions import UserAlreadyExists
@@ -32,8 +35,22 @@ from fastapi_users.jwt import SecretType, decode_jwt, generate_jwt
 from httpx_oauth.integrations.fastapi import OAuth2AuthorizeCallback
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
-import requests
-from asyncio import gather, sleep
+from ari import ari_client
+from ari_events import ari_events
+from call_log import call_log, campaign_stats
+from retries import retry_queue
+from jobs import jobs
+from connections import manager
+from kanban import KANBAN_BATCH_SIZE, KANBAN_PAGE_SIZE, KanbanBatch, allowed_topics, board_topic, card_cursor, card_topics, \
+    card_visible, changes_since, column_topics, column_visible, forget_column, last_seq, migrate_kanban_owners, \
+    migrate_kanban_ranks, migrate_kanban_search, page_cards, rank_after, rank_last, search_cards, visible_columns
+from phone_import import IMPORT_FORMATS, IMPORT_UPLOAD_CHUNK, import_format, import_phone_file
+from phone_lists import PHONE_PAGE_SIZE, add_numbers, clear_numbers, migrate_phone_lists, page_numbers, remove_numbers, \
+    split_numbers
+from sound_files import SOUND_BLOBS_DIRECTORY, SOUND_PEAKS_SAMPLES, SOUND_READY, SOUND_SOURCES_DIRECTORY, SOUND_UPLOAD_CHUNK, add_blob_reference, \
+    blob_path, blob_peaks_path, release_blob_reference, sound_access, transcoder
+from campaigns import scheduler, get_campaign, CAMPAIGN_QUEUED, CAMPAIGN_RUNNING, CAMPAIGN_PAUSED, CAMPAIGN_CANCELLED, \
+    CAMPAIGN_COMPLETED, CAMPAIGN_FAILED
 import json
 
 async def add_test_data():
@@ -61,7 +78,8 @@ async def add_test_data():
             user_id=user.id
         )
 
-        phones = [str(random.randint(1000000, 9999999)) for _ in range(10)]  # Генерация 10 телефонных номеров
+        # Генерация 10 телефонных номеров в формате E.164 (мобильные РФ)
+        phones = [f"+79{random.randint(0, 999999999):09d}" for _ in range(10)]
         await create_phone_list_pro(
             name=f"Test Phone List {user.id}",
             phones=phones,
@@ -78,8 +96,27 @@ async def add_test_data():
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await create_db_and_tables()
+    await migrate_phone_lists()
+    await migrate_kanban_search()
+    await migrate_kanban_owners()
+    await migrate_kanban_ranks()
     # await add_test_data()
+    await ari_client.open()
+    await call_log.start()
+    await retry_queue.start()
+    await ari_events.start()
+    await transcoder.restore()
+    await scheduler.restore()
+    await manager.start()
     yield
+    await manager.stop()
+    await jobs.shutdown()
+    transcoder.shutdown()
+    await scheduler.shutdown()
+    await ari_events.stop()
+    await retry_queue.stop()
+    await call_log.stop()
+    await ari_client.close()
 
 config = Config('.env')
 
@@ -89,10 +126,6 @@ GOOGLE_REDIRECT_URI = config('GOOGLE_REDIRECT_URI')
 
 REACT_REDIRECT_URI = config('REACT_REDIRECT_URI')
 
-ARI_BASE_URL = config('ARI_BASE_URL')
-ARI_USERNAME = config('ARI_USERNAME')
-ARI_PASSWORD = config('ARI_PASSWORD')
-
 app = FastAPI(lifespan=lifespan)
 origins = ["*"]
 app.add_middleware(
@@ -121,68 +154,32 @@ app.add_middleware(SessionMiddleware, secret_key="!secret")
 # os.makedirs(callfiles_directory, exist_ok=True)
 
 
-# Helper function to chunk the list
-def chunk_list(lst, n):
-    """Yield successive n-sized chunks from lst."""
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
-
-async def make_call(phone_number, sound_file, reaction):
-    """Make a single call request"""
-    phone_number_formated = str(phone_number).replace("(", "").replace(")", "").replace(" ", "").strip()
-    data = {
-        "variables": {
-            "SOUND_FILE": os.path.abspath(sound_file),
-            "REACTION": json.dumps(reaction)
-        }
-    }
-    return requests.post(
-        f'{ARI_BASE_URL}/channels?endpoint=PJSIP/{phone_number_formated}&extension=55555&context=Autocall&timeout=30&api_key={ARI_USERNAME}:{ARI_PASSWORD}',
-        json=data,
-        headers={"Content-Type": "application/json"}
-    )
-
-
 callfile_router = APIRouter()
 
-@callfile_router.post("/create-callfile/")
+@callfile_router.post("/create-callfile/", status_code=status.HTTP_202_ACCEPTED)
 async def create_callfile(
     callfile: CallFile,
+    user: User = Depends(current_active_user),
     session: AsyncSession = Depends(get_async_session)
 ):
-#     callfile_path = "/var/spool/asterisk/outgoing"
-
-    # query = select(CompanyModel).filter_by(id=callfile.companyId)
-    # result = await session.execute(query)
-    # company = result.scalars().first()
-
-    # query = select(PhoneListModel).filter_by(id=company.phones_id)
-    # result = await session.execute(query)
-    # company_phones = result.scalars().first()
+    query = select(CompanyModel).filter_by(id=callfile.companyId, user_id=user.id)
+    result = await session.execute(query)
+    company = result.scalars().first()
+    if company is None:
+        raise HTTPException(status_code=404, detail="Company not found")
 
-    company_phones = ["1234"]
+    query = select(SoundFileModel).filter_by(file_path=callfile.filepath, user_id=user.id)
+    sound_file = (await session.execute(query)).scalars().first()
+    if sound_file is not None and sound_file.status != SOUND_READY:
+        raise HTTPException(status_code=409, detail=f"Sound file is {sound_file.status}")
 
-    if not company_phones:
+    campaign = await scheduler.submit(session, company, callfile, user.id)
+    if campaign is None:
         raise HTTPException(status_code=404, detail="No phone numbers found for this company ID")
-    
-    try:
-        # Split phone numbers into batches of 5
-        phone_batches = list(chunk_list(company_phones, 5))
-
-        for batch in phone_batches:
-            # Process batch of 5 calls simultaneously
-            # print(callfile.reaction)
-            tasks = [make_call(phone, callfile.filepath, callfile.reaction) for phone in batch]
-            responses = await gather(*tasks)
-            # for res in responses:
-            #     print(res.text)
-            
-            # Wait 30 seconds before next batch
-            if batch != phone_batches[-1]:  # Don't wait after the last batch
-                await sleep(30)
-        
-        return {"message": "Calls initiated successfully"}
 
+    return {"message": "Campaign started", "campaign_id": campaign.id}
+
+#     callfile_path = "/var/spool/asterisk/outgoing"
 #     created_files = []
 
     # try:
@@ -215,14 +212,85 @@ async def create_callfile(
 
 #             created_files.append(filename)
 #             shutil.move(filename, callfile_path)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error initiating calls: {str(e)}")
+#     except Exception as e:
 #         for file in created_files:
 #             os.remove(file);
 #             created_files.pop(file)
 #         return {"message": "Callfile error. Existed files has been removed."}
 #     return {"message": "Callfile created successfully", "path": created_files}
 
+
+async def get_user_campaign(campaign_id: int, user: User, session: AsyncSession) -> CampaignModel:
+    campaign = await get_campaign(session, campaign_id, user.id)
+    if campaign is None:
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    return campaign
+
+
+@callfile_router.get("/campaigns/", response_model=list[Campaign])
+async def read_campaigns(
+        user: User = Depends(current_active_user),
+        session: AsyncSession = Depends(get_async_session)
+):
+    query = select(CampaignModel).filter_by(user_id=user.id).order_by(CampaignModel.id.desc())
+    result = await session.execute(query)
+    return result.scalars().all()
+
+
+@callfile_router.get("/campaigns/{campaign_id}", response_model=Campaign)
+async def read_campaign(
+        campaign_id: int,
+        user: User = Depends(current_active_user),
+        session: AsyncSession = Depends(get_async_session)
+):
+    return await get_user_campaign(campaign_id, user, session)
+
+
+@callfile_router.get("/campaigns/{campaign_id}/stats", response_model=CampaignStats)
+async def read_campaign_stats(
+        campaign_id: int,
+        user: User = Depends(current_active_user),
+        session: AsyncSession = Depends(get_async_session)
+):
+    await get_user_campaign(campaign_id, user, session)
+    return await campaign_stats(session, campaign_id)
+
+
+@callfile_router.post("/campaigns/{campaign_id}/pause", response_model=Campaign)
+async def pause_campaign(
+        campaign_id: int,
+        user: User = Depends(current_active_user),
+        session: AsyncSession = Depends(get_async_session)
+):
+    campaign = await get_user_campaign(campaign_id, user, session)
+    if campaign.status not in (CAMPAIGN_QUEUED, CAMPAIGN_RUNNING):
+        raise HTTPException(status_code=409, detail=f"Campaign is {campaign.status}")
+    return await scheduler.pause(session, campaign)
+
+
+@callfile_router.post("/campaigns/{campaign_id}/resume", response_model=Campaign)
+async def resume_campaign(
+        campaign_id: int,
+        user: User = Depends(current_active_user),
+        session: AsyncSession = Depends(get_async_session)
+):
+    campaign = await get_user_campaign(campaign_id, user, session)
+    if campaign.status not in (CAMPAIGN_PAUSED, CAMPAIGN_FAILED):
+        raise HTTPException(status_code=409, detail=f"Campaign is {campaign.status}")
+    return await scheduler.resume(session, campaign)
+
+
+@callfile_router.post("/campaigns/{campaign_id}/cancel", response_model=Campaign)
+async def cancel_campaign(
+        campaign_id: int,
+        user: User = Depends(current_active_user),
+        session: AsyncSession = Depends(get_async_session)
+):
+    campaign = await get_user_campaign(campaign_id, user, session)
+    if campaign.status in (CAMPAIGN_CANCELLED, CAMPAIGN_COMPLETED):
+        raise HTTPException(status_code=409, detail=f"Campaign is {campaign.status}")
+    return await scheduler.cancel(session, campaign)
+
 # endregion
 
 # region CompanyRouter
@@ -325,6 +393,23 @@ async def delete_company(
 phone_router = APIRouter()
 
 
+async def get_user_phone_list(phone_list_id: int, user: User, session: AsyncSession) -> PhoneListModel:
+    query = select(PhoneListModel).filter_by(id=phone_list_id, user_id=user.id)
+    result = await session.execute(query)
+    phone_list = result.scalars().first()
+    if phone_list is None:
+        raise HTTPException(status_code=404, detail="Phone list not found")
+    return phone_list
+
+
+def valid_numbers(numbers) -> list[str]:
+    """Normalized numbers of a request; 422 listing the invalid ones if there are any"""
+    valid, invalid = split_numbers(numbers)
+    if invalid:
+        raise HTTPException(status_code=422, detail={"message": "Invalid phone numbers", "numbers": invalid[:100]})
+    return valid
+
+
 # Создание списка телефонов
 @phone_router.post("/phone-lists/", response_model=PhoneList)
 async def create_phone_list(
@@ -332,8 +417,10 @@ async def create_phone_list(
         user: User = Depends(current_active_user),
         session: AsyncSession = Depends(get_async_session)
 ):
-    new_phone_list = PhoneListModel(**phone_list_data.dict(), user_id=user.id)
+    new_phone_list = PhoneListModel(name=phone_list_data.name, user_id=user.id)
     session.add(new_phone_list)
+    await session.flush()
+    await add_numbers(session, new_phone_list.id, valid_numbers(phone_list_data.phones or []))
     await session.commit()
     await session.refresh(new_phone_list)
     return new_phone_list
@@ -346,12 +433,7 @@ async def read_phone_list(
         user: User = Depends(current_active_user),
         session: AsyncSession = Depends(get_async_session)
 ):
-    query = select(PhoneListModel).filter_by(id=phone_list_id, user_id=user.id)
-    result = await session.execute(query)
-    phone_list = result.scalars().first()
-    if phone_list is None:
-        raise HTTPException(status_code=404, detail="Phone list not found")
-    return phone_list
+    return await get_user_phone_list(phone_list_id, user, session)
 
 
 # Получение всех списков телефонов пользователя
@@ -366,7 +448,7 @@ async def read_phone_lists(
     return phone_lists
 
 
-# Обновление списка телефонов
+# Обновление списка телефонов (если передан phones, номера списка заменяются)
 @phone_router.put("/phone-lists/{phone_list_id}", response_model=PhoneList)
 async def update_phone_list(
         phone_list_id: int,
@@ -374,14 +456,13 @@ async def update_phone_list(
         user: User = Depends(current_active_user),
         session: AsyncSession = Depends(get_async_session)
 ):
-    query = select(PhoneListModel).filter_by(id=phone_list_id, user_id=user.id)
-    result = await session.execute(query)
-    phone_list = result.scalars().first()
-    if phone_list is None:
-        raise HTTPException(status_code=404, detail="Phone list not found")
-    for var, value in vars(phone_list_data).items():
-        setattr(phone_list, var, value) if value else None
-    session.add(phone_list)
+    phone_list = await get_user_phone_list(phone_list_id, user, session)
+    if phone_list_data.name:
+        phone_list.name = phone_list_data.name
+    if phone_list_data.phones:
+        numbers = valid_numbers(phone_list_data.phones)
+        await clear_numbers(session, phone_list.id)
+        await add_numbers(session, phone_list.id, numbers)
     await session.commit()
     await session.refresh(phone_list)
     return phone_list
@@ -394,50 +475,145 @@ async def delete_phone_list(
         user: User = Depends(current_active_user),
         session: AsyncSession = Depends(get_async_session)
 ):
-    query = select(PhoneListModel).filter_by(id=phone_list_id, user_id=user.id)
-    result = await session.execute(query)
-    phone_list = result.scalars().first()
-    if phone_list is None:
-        raise HTTPException(status_code=404, detail="Phone list not found")
+    phone_list = await get_user_phone_list(phone_list_id, user, session)
+    await clear_numbers(session, phone_list.id)
     await session.delete(phone_list)
     await session.commit()
 
 
+# Номера списка постранично: next_cursor передаётся как after в следующий запрос
+@phone_router.get("/phone-lists/{phone_list_id}/numbers", response_model=PhoneNumberPage)
+async def read_phone_list_numbers(
+        phone_list_id: int,
+        after: int = Query(0, ge=0),
+        limit: int = Query(100, ge=1, le=PHONE_PAGE_SIZE),
+        user: User = Depends(current_active_user),
+        session: AsyncSession = Depends(get_async_session)
+):
+    await get_user_phone_list(phone_list_id, user, session)
+    numbers = await page_numbers(session, phone_list_id, after, limit)
+    next_cursor = numbers[-1].id if len(numbers) == limit else None
+    return {"numbers": numbers, "next_cursor": next_cursor}
+
+
+@phone_router.post("/phone-lists/{phone_list_id}/numbers", response_model=PhoneList)
+async def add_phone_list_numbers(
+        phone_list_id: int,
+        phone_numbers: PhoneNumbers,
+        user: User = Depends(current_active_user),
+        session: AsyncSession = Depends(get_async_session)
+):
+    phone_list = await get_user_phone_list(phone_list_id, user, session)
+    await add_numbers(session, phone_list.id, valid_numbers(phone_numbers.numbers))
+    await session.commit()
+    await session.refresh(phone_list)
+    return phone_list
+
+
+@phone_router.delete("/phone-lists/{phone_list_id}/numbers", response_model=PhoneList)
+async def remove_phone_list_numbers(
+        phone_list_id: int,
+        phone_numbers: PhoneNumbers,
+        user: User = Depends(current_active_user),
+        session: AsyncSession = Depends(get_async_session)
+):
+    phone_list = await get_user_phone_list(phone_list_id, user, session)
+    # Невалидные значения удаляются как есть: так удаляются номера, сохранённые невалидными при миграции
+    valid, invalid = split_numbers(phone_numbers.numbers)
+    await remove_numbers(session, phone_list.id, valid + [raw.strip() for raw in invalid])
+    await session.commit()
+    await session.refresh(phone_list)
+    return phone_list
+
+
+# Импорт номеров из файла (CSV/TXT, XLSX при установленном openpyxl) в фоне
+@phone_router.post("/phone-lists/{phone_list_id}/import", response_model=JobStatus, status_code=status.HTTP_202_ACCEPTED)
+async def import_phone_list(
+        phone_list_id: int,
+        file: UploadFile = File(...),
+        user: User = Depends(current_active_user),
+        session: AsyncSession = Depends(get_async_session)
+):
+    phone_list = await get_user_phone_list(phone_list_id, user, session)
+    extension = import_format(file.filename)
+    if extension is None:
+        raise HTTPException(status_code=415, detail=f"Unsupported file type, expected one of {', '.join(IMPORT_FORMATS)}")
+
+    # Сессия запроса живёт до конца ответа: соединение возвращается в пул до копирования файла
+    await release_connection(session)
+    fd, path = tempfile.mkstemp(suffix=extension)
+    with os.fdopen(fd, 'wb') as out_file:
+        while chunk := await file.read(IMPORT_UPLOAD_CHUNK):
+            out_file.write(chunk)
+
+    job = jobs.create("phone_import", user.id)
+    jobs.start(job, lambda job: import_phone_file(job, phone_list.id, path, extension))
+    return job
+
+
+@phone_router.get("/phone-lists/imports/{job_id}", response_model=JobStatus)
+async def read_phone_list_import(
+        job_id: str,
+        user: User = Depends(current_active_user),
+):
+    job = jobs.get(job_id, user.id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Import not found")
+    return job
+
+
 # endregion
 # region SoundFiles
 files_directory = "files"
 os.makedirs(files_directory, exist_ok=True)
+os.makedirs(SOUND_SOURCES_DIRECTORY, exist_ok=True)
 soundfile_router = APIRouter()
 
 
-# Загрузка звукового файла
-@soundfile_router.post("/sound-files/", response_model=SoundFile)
+# Загрузка звукового файла: файл пишется на диск частями и хранится по хешу содержимого,
+# конвертация в 8 кГц моно идёт в фоне и только для ещё не встречавшегося содержимого
+@soundfile_router.post("/sound-files/", response_model=SoundFileUpload, status_code=status.HTTP_202_ACCEPTED)
 async def upload_sound_file(
         file: UploadFile = File(...),
         user: User = Depends(current_active_user),
         session: AsyncSession = Depends(get_async_session)
 ):
-    file_location = f"{files_directory}/{file.filename}"
-    with open(file_location, 'wb') as out_file:
-        content = await file.read()
-        out_file.write(content)
-
-    audio = AudioSegment.from_file(file_location)
+    extension = os.path.splitext(file.filename)[1].lower()
+    # Сессия запроса живёт до конца ответа: соединение возвращается в пул до копирования файла
+    await release_connection(session)
+    digest = hashlib.sha256()
+    fd, file_location = tempfile.mkstemp(suffix=extension, dir=SOUND_BLOBS_DIRECTORY)
+    with os.fdopen(fd, 'wb') as out_file:
+        while chunk := await file.read(SOUND_UPLOAD_CHUNK):
+            digest.update(chunk)
+            out_file.write(chunk)
+    blob_hash = digest.hexdigest()
+
+    blob_status, needs_transcode = await add_blob_reference(session, blob_hash, extension, file_location)
     wav_filename = file.filename.rsplit('.', 1)[0] + '.wav'
-    wav_file_location = f"{files_directory}/{wav_filename}"
-
-    audio = audio.set_frame_rate(8000)
-    audio = audio.set_channels(1)
-    audio.export(wav_file_location, format="wav", parameters=["-acodec", "pcm_s16le"])
-
-    # Optionally, delete the original OGG file
-    os.remove(file_location)
-
-    sound_file = SoundFileModel(name=wav_filename, file_path=wav_file_location, user_id=user.id)
+    sound_file = SoundFileModel(name=wav_filename, file_path=blob_path(blob_hash), user_id=user.id,
+                                status=blob_status, blob_hash=blob_hash)
     session.add(sound_file)
     await session.commit()
     await session.refresh(sound_file)
-    return sound_file
+
+    job_id = None
+    if needs_transcode:
+        job = jobs.create("sound_transcode", user.id)
+        jobs.start(job, lambda job: transcoder.transcode(job, blob_hash, extension))
+        job_id = job.id
+    return {**SoundFile.model_validate(sound_file, from_attributes=True).model_dump(), "job_id": job_id}
+
+
+@soundfile_router.get("/sound-files/jobs/{job_id}", response_model=JobStatus)
+async def read_sound_file_job(
+        job_id: str,
+        user: User = Depends(current_active_user),
+):
+    job = jobs.get(job_id, user.id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
 
 @soundfile_router.get("/sound-files/", response_model=list[SoundFile])
@@ -468,11 +644,84 @@ async def read_sound_file(
     return sound_file
 
 
+def blob_file_response(request: Request, path: str, blob_hash: str, media_type: str, version: Optional[str],
+                       headers: dict = None) -> Response:
+    """ETag берётся из хеша содержимого. URL с ?v=<хеш> (audio_url, peaks_url) всегда указывает на одно
+    и то же содержимое и кэшируется навсегда; без него или со старым хешем (id после удаления может
+    достаться другому файлу) браузер перепроверяет кэш через If-None-Match"""
+    headers = {
+        **(headers or {}),
+        "ETag": f'"{blob_hash}"',
+        "Cache-Control": "private, max-age=31536000, immutable" if version == blob_hash else "private, no-cache",
+    }
+    if headers["ETag"] in request.headers.get("if-none-match", ""):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+
+def legacy_sound_path(file_path: str) -> Optional[str]:
+    """Путь файла, загруженного до хранилища по хешу, если он лежит в files/ вне хранилища"""
+    path = os.path.realpath(file_path)
+    root = os.path.realpath(files_directory)
+    blobs = os.path.realpath(SOUND_BLOBS_DIRECTORY)
+    if os.path.commonpath([path, root]) != root or os.path.commonpath([path, blobs]) == blobs:
+        return None
+    return path
+
+
+async def get_sound_access(sound_file_id: int, user_id: int, session: AsyncSession):
+    access = await sound_access.get(session, sound_file_id, user_id)
+    if access is None or access.user_id != user_id:
+        raise HTTPException(status_code=404, detail="Sound file not found")
+    return access
+
+
+# Прослушивание звукового файла, с поддержкой Range для перемотки.
+# Пользователь берётся из JWT без запроса к БД: плеер делает запрос на каждый фрагмент
+@soundfile_router.get("/sound-files/{sound_file_id}/audio")
+async def read_sound_file_audio(
+        sound_file_id: int,
+        request: Request,
+        v: Optional[str] = None,
+        user_id: int = Depends(current_token_user_id),
+        session: AsyncSession = Depends(get_async_session)
+):
+    access = await get_sound_access(sound_file_id, user_id, session)
+    # Файл может отдаваться долго, соединение с БД ему не нужно
+    await release_connection(session)
+    if access.blob_hash is None:
+        # Файлы, загруженные до хранилища по хешу, могут быть перезаписаны
+        path = legacy_sound_path(access.file_path)
+        if path is None or not os.path.isfile(path):
+            raise HTTPException(status_code=404, detail="Sound file not found")
+        return FileResponse(path, media_type="audio/wav", headers={"Cache-Control": "private, no-cache"})
+    # Путь в записи не используется: файл хранилища определяется только хешем
+    return blob_file_response(request, blob_path(access.blob_hash), access.blob_hash, "audio/wav", v)
+
+
+# Пики формы волны для превью: пары (min, max) int8, по одной на SOUND_PEAKS_SAMPLES отсчётов
+@soundfile_router.get("/sound-files/{sound_file_id}/peaks")
+async def read_sound_file_peaks(
+        sound_file_id: int,
+        request: Request,
+        v: Optional[str] = None,
+        user_id: int = Depends(current_token_user_id),
+        session: AsyncSession = Depends(get_async_session)
+):
+    access = await get_sound_access(sound_file_id, user_id, session)
+    await release_connection(session)
+    path = blob_peaks_path(access.blob_hash) if access.blob_hash else None
+    if path is None or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Peaks not found")
+    headers = {"X-Samples-Per-Peak": str(SOUND_PEAKS_SAMPLES), "X-Sample-Rate": "8000"}
+    return blob_file_response(request, path, access.blob_hash, "application/octet-stream", v, headers)
+
+
 # Обновление информации о звуковом файле (без загрузки нового файла)
 @soundfile_router.put("/sound-files/{sound_file_id}", response_model=SoundFile)
 async def update_sound_file(
         sound_file_id: int,
-        sound_file_data: SoundFileCreate,
+        sound_file_data: SoundFileUpdate,
         user: User = Depends(current_active_user),
         session: AsyncSession = Depends(get_async_session)
 ):
@@ -489,6 +738,7 @@ async def update_sound_file(
     session.add(sound_file)
     await session.commit()
     await session.refresh(sound_file)
+    sound_access.forget(sound_file.id)
     return sound_file
 
 
@@ -505,79 +755,159 @@ async def delete_sound_file(
     if sound_file is None:
         raise HTTPException(status_code=404, detail="Sound file not found")
     await session.delete(sound_file)
+    sound_access.forget(sound_file.id)
+    if sound_file.blob_hash is not None:
+        # Файл общий для всех загрузок с тем же содержимым: удаляется вместе с последней ссылкой
+        await release_blob_reference(session, sound_file.blob_hash)
+        await session.commit()
+        return
     await session.commit()
-    # Удаление файла из файловой системы
-    os.remove(sound_file.file_path)
+    # Удаление файла из файловой системы, только если он лежит в files/ вне хранилища
+    path = legacy_sound_path(sound_file.file_path)
+    if path is not None and os.path.isfile(path):
+        os.remove(path)
 
 
 # endregion
 
 # region CRM Kanban
 
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
-
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
-
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
-
-    async def broadcast(self, message: dict):
-        for connection in self.active_connections:
-            await connection.send_json(message)
-
-
-manager = ConnectionManager()
-
-
+# Клиент с токеном (?token=<JWT>) видит общую доску, свою доску и назначенные ему карточки,
+# без токена — только общую доску. Изменять можно только видимые колонки и их карточки
 @app.websocket('/ws/kanban')
-async def websocket_endpoint(
-    websocket: WebSocket,
-    session: AsyncSession = Depends(get_async_session)
-):
-    await manager.connect(websocket)
+async def websocket_endpoint(websocket: WebSocket, token: Optional[str] = None):
+    user = await get_user_from_token(token) if token else None
+    if token and user is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    user_id = user.id if user else None
+    await manager.connect(websocket, user_id)
+    manager.subscribe(websocket, allowed_topics(user_id))
     try:
         while True:
-            data = await websocket.receive_json()
-            action = data.get('action')
-            if action == "create_column":
-                await create_kanban_column(websocket, data["column"], session)
-            elif action == "get_columns":
-                await get_kanban_columns(websocket, session)
-            elif action == "update_column":
-                await update_kanban_column(websocket, data["kanban_column_id"], data["column"], session)
-            elif action == "delete_column":
-                await delete_kanban_column(websocket, data["kanban_column_id"], session)
-            elif action == "create_card":
-                await create_kanban_card(websocket, data["kanban_card"], session)
-            elif action == "get_cards":
-                await get_kanban_cards(websocket, session, data.get("kanban_column_id"))
-            elif action == "update_card":
-                await update_kanban_card(websocket, data["kanban_card_id"], data["kanban_card"], session)
-            elif action == "delete_card":
-                await delete_kanban_card(websocket, data["kanban_card_id"], session)
+            message = await websocket.receive_text()
+            data = None
+            # Каждое сообщение обрабатывается в своей короткой сессии: identity map не растёт
+            # за время жизни соединения, а ошибка одного действия не ломает остальные
+            try:
+                data = json.loads(message)
+                async with async_session_maker() as session:
+                    await handle_kanban_message(websocket, data, session)
+            except WebSocketDisconnect:
+                raise
+            except Exception as e:
+                # ValueError — ошибка в запросе клиента (нет карточки, неверные поля, не JSON);
+                # остальные исключения — ошибки сервера, их трейсбек нужен в логе
+                if isinstance(e, ValueError):
+                    print(f"Kanban action rejected: {e!r}")
+                else:
+                    print(f"Kanban action failed: {e!r}")
+                    traceback.print_exc()
+                action = data.get('action') if isinstance(data, dict) else None
+                await manager.send(websocket, {"action": action, "error": str(e) or type(e).__name__})
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(websocket)
 
 
+# Состояние очередей WebSocket-клиентов
+@app.get('/api/ws/metrics')
+async def websocket_metrics(user: User = Depends(current_active_user)):
+    return manager.metrics()
+
+
+async def handle_kanban_message(websocket: WebSocket, data: dict, session: AsyncSession):
+    action = data.get('action')
+    if action in ("subscribe", "unsubscribe"):
+        await update_kanban_subscriptions(websocket, action, data.get("topics", []))
+    elif action == "get_columns":
+        await get_kanban_columns(websocket, session)
+    elif action == "resume":
+        await resume_kanban(websocket, data["seq"], session)
+    elif action == "get_cards":
+        await get_kanban_cards(websocket, session, data.get("kanban_column_id"), data.get("after"), data.get("limit", KANBAN_PAGE_SIZE))
+    elif action == "search_cards":
+        await search_kanban_cards(websocket, session, data["query"], data.get("kanban_column_id"), data.get("limit", KANBAN_PAGE_SIZE))
+    elif action == "batch":
+        await apply_kanban_batch(websocket, data["ops"], session)
+    else:
+        batch = KanbanBatch()
+        if not await apply_kanban_mutation(websocket, data, session, batch):
+            await manager.send(websocket, {"action": action, "error": "Unknown action"})
+            return
+        await batch.commit(session)
+
+
+# Изменения только применяются к сессии и копят события в batch; коммит и рассылка — в KanbanBatch.commit
+async def apply_kanban_mutation(websocket: WebSocket, data: dict, session: AsyncSession, batch: KanbanBatch) -> bool:
+    action = data.get('action')
+    if action == "create_column":
+        await create_kanban_column(websocket, data["column"], session, batch)
+    elif action == "update_column":
+        await update_kanban_column(websocket, data["kanban_column_id"], data["column"], session, batch)
+    elif action == "move_column":
+        await move_kanban_column(websocket, data["kanban_column_id"], data.get("after_id"), session, batch)
+    elif action == "delete_column":
+        await delete_kanban_column(websocket, data["kanban_column_id"], session, batch)
+    elif action == "create_card":
+        await create_kanban_card(websocket, data["kanban_card"], session, batch)
+    elif action == "update_card":
+        await update_kanban_card(websocket, data["kanban_card_id"], data["kanban_card"], session, batch)
+    elif action == "move_card":
+        await move_kanban_card(websocket, data["kanban_card_id"], data.get("column_id"), data.get("after_id"), session, batch)
+    elif action == "delete_card":
+        await delete_kanban_card(websocket, data["kanban_card_id"], session, batch)
+    else:
+        return False
+    return True
+
+
+# Пакет: {"action": "batch", "ops": [{"action": "update_card", ...}, ...]} — все операции в одной транзакции
+# и одной рассылке; при ошибке любой операции не применяется ни одна
+async def apply_kanban_batch(websocket: WebSocket, ops: List[dict], session: AsyncSession):
+    if len(ops) > KANBAN_BATCH_SIZE:
+        raise ValueError(f"At most {KANBAN_BATCH_SIZE} operations per batch")
+    # Карточки пакета загружаются одним запросом, дальше session.get берёт их из identity map
+    # (пока на них ссылается batch.cards)
+    card_ids = [op["kanban_card_id"] for op in ops if "kanban_card_id" in op]
+    batch = KanbanBatch()
+    if card_ids:
+        batch.cards = (await session.execute(select(KanbanCard).where(KanbanCard.id.in_(card_ids)))).scalars().all()
+    for index, op in enumerate(ops):
+        try:
+            if not await apply_kanban_mutation(websocket, op, session, batch):
+                raise ValueError("Unknown action")
+        except Exception as e:
+            raise ValueError(f"Operation {index} ({op.get('action')}) failed: {e}") from e
+    await batch.commit(session)
+
+
+async def update_kanban_subscriptions(websocket: WebSocket, action: str, topics: List[str]):
+    if action == "subscribe":
+        # Подписаться можно только на доступные клиенту топики
+        manager.subscribe(websocket, set(topics) & allowed_topics(manager.user_id(websocket)))
+    else:
+        manager.unsubscribe(websocket, topics)
+    await manager.send(websocket, {"action": action, "topics": sorted(manager.topics(websocket))})
+
+
+# Новая колонка общая; личная (видна только автору) — {"action": "create_column", "column": {..., "private": true}}
 async def create_kanban_column(
     websocket: WebSocket,
     column: KanbanColumnCreate,
     # user: User = Depends(current_active_user),
-    session: AsyncSession = Depends(get_async_session)
+    session: AsyncSession,
+    batch: KanbanBatch,
 ):
-    new_column = KanbanColumn(**column)
+    fields = {key: value for key, value in column.items() if key != "private"}
+    owner = manager.user_id(websocket) if column.get("private") else None
+    new_column = KanbanColumn(**fields, user_id=owner, rank=await rank_last(session, KanbanColumn), tasks=[])
     session.add(new_column)
-    await session.commit()
-
-    query = select(KanbanColumn).options(selectinload(KanbanColumn.tasks)).filter_by(id=new_column.id)
-    result = await session.execute(query)
-    loaded_column = result.scalars().first()
+    await session.flush()
+    batch.check_rank(new_column.rank, columns=True)
 
-    await manager.broadcast({"action": "create_column", "column": KanbanColumnResponse.model_validate(loaded_column).model_dump(mode='json')})
+    batch.add({board_topic(new_column.user_id)}, {"action": "create_column", "column": KanbanColumnResponse.model_validate(new_column)})
 
 
 async def get_kanban_columns(
@@ -585,7 +915,14 @@ async def get_kanban_columns(
     # user: User = Depends(current_active_user),
     session: AsyncSession = Depends(get_async_session)
 ):
-    query = select(KanbanColumn).options(selectinload(KanbanColumn.tasks))
+    # seq читается до доски: события, попавшие между запросами, клиент получит повторно, но не потеряет
+    seq = await last_seq(session)
+    # Только колонки: карточки клиент догружает по колонкам через get_cards
+    query = (
+        select(KanbanColumn).options(noload(KanbanColumn.tasks))
+        .where(visible_columns(manager.user_id(websocket)))
+        .order_by(KanbanColumn.rank, KanbanColumn.id)
+    )
     result = await session.execute(query)
     column = result.scalars().all()
 
@@ -596,7 +933,17 @@ async def get_kanban_columns(
     #     "tag_color": col.tag_color
     # } for col in column]
 
-    await websocket.send_json({"action": "get_columns", "columns": [KanbanColumnResponse.model_validate(col).model_dump(mode='json') for col in column]})
+    await manager.send(websocket, {"action": "get_columns", "seq": seq, "columns": [KanbanColumnResponse.model_validate(col) for col in column]})
+
+
+# Переподключение: {"action": "resume", "seq": <последний полученный seq>} — клиент получает только
+# пропущенные события, а полную доску (get_columns) только если журнал уже обрезан
+async def resume_kanban(websocket: WebSocket, seq: int, session: AsyncSession):
+    last, changes = await changes_since(session, seq, manager.topics(websocket))
+    if changes is None:
+        await get_kanban_columns(websocket, session)
+    else:
+        await manager.send(websocket, {"action": "resume", "seq": last, "changes": changes})
 
 
 async def update_kanban_column(
@@ -604,46 +951,77 @@ async def update_kanban_column(
         kanban_column_id: int,
         kanban_column: KanbanColumnCreate,
         # user: User = Depends(current_active_user),
-        session: AsyncSession = Depends(get_async_session)
+        session: AsyncSession,
+        batch: KanbanBatch,
 ):
-    query = select(KanbanColumn).filter_by(id=kanban_column_id)
+    if not await column_visible(session, manager.user_id(websocket), kanban_column_id):
+        raise ValueError("Column not found")
+    query = select(KanbanColumn).options(noload(KanbanColumn.tasks)).filter_by(id=kanban_column_id)
     result = await session.execute(query)
     new_kanban_column = result.scalars().first()
 
     if new_kanban_column:
-        for var, value in vars(kanban_column).items():
+        # Частичное обновление: проверяются только переданные поля
+        fields = KanbanColumnCreate.model_validate({"title": new_kanban_column.title, **kanban_column})
+        # Владелец колонки не меняется: private учитывается только при создании
+        for var, value in fields.model_dump(include=set(kanban_column) - {"private"}).items():
             setattr(new_kanban_column, var, value) if value else None
         session.add(new_kanban_column)
-        await session.commit()
-        await session.refresh(new_kanban_column)
-        await manager.broadcast({"action": "update_column", "column": new_kanban_column})
+        batch.add({board_topic(new_kanban_column.user_id)}, {"action": "update_column", "column": KanbanColumnResponse.model_validate(new_kanban_column)})
     else:
-        await websocket.send_json({"error": "Column not found"})
+        raise ValueError("Column not found")
 
 
 async def delete_kanban_column(
         websocket: WebSocket,
         kanban_column_id: int,
         # user: User = Depends(current_active_user),
-        session: AsyncSession = Depends(get_async_session)
+        session: AsyncSession,
+        batch: KanbanBatch,
 ):
+    if not await column_visible(session, manager.user_id(websocket), kanban_column_id):
+        raise ValueError("Column not found")
     query = select(KanbanColumn).filter_by(id=kanban_column_id)
     result = await session.execute(query)
     kanban_column = result.scalars().first()
     if kanban_column:
+        topics = {board_topic(kanban_column.user_id)}
         await session.delete(kanban_column)
-        await session.commit()
-        await manager.broadcast({"action": "delete_column", "kanban_column_id": kanban_column_id})
+        forget_column(session, kanban_column_id)
+        batch.add(topics, {"action": "delete_column", "kanban_column_id": kanban_column_id})
     else:
-        await websocket.send_json({"error": "Column not found"})
+        raise ValueError("Column not found")
+
+
+# Перенос колонки: {"action": "move_column", "kanban_column_id": ..., "after_id": <колонка слева или null>}.
+# Меняется только rank переносимой колонки
+async def move_kanban_column(
+        websocket: WebSocket,
+        kanban_column_id: int,
+        after_id: Optional[int],
+        session: AsyncSession,
+        batch: KanbanBatch,
+):
+    user_id = manager.user_id(websocket)
+    kanban_column = await session.get(KanbanColumn, kanban_column_id)
+    if kanban_column is None or not await column_visible(session, user_id, kanban_column_id):
+        raise ValueError("Column not found")
+    if after_id is not None and not await column_visible(session, user_id, after_id):
+        raise ValueError("Column not found")
+    kanban_column.rank = await rank_after(session, KanbanColumn, after_id, kanban_column.id)
+    batch.add({board_topic(kanban_column.user_id)}, {"action": "move_column", "kanban_column_id": kanban_column.id, "rank": kanban_column.rank})
+    batch.check_rank(kanban_column.rank, columns=True)
 
 
 async def create_kanban_card(
     websocket: WebSocket,
     kanban_card: KanbanCardCreate,
     # user: User = Depends(current_active_user),
-    session: AsyncSession = Depends(get_async_session),
+    session: AsyncSession,
+    batch: KanbanBatch,
 ):
+    if not await column_visible(session, manager.user_id(websocket), kanban_card["column_id"]):
+        raise ValueError("Column not found")
     card_datetime = None
     if kanban_card["datetime"] and isinstance(kanban_card["datetime"], str):
         # Remove 'Z' and handle UTC timezone
@@ -659,11 +1037,13 @@ async def create_kanban_card(
         comment=kanban_card["comment"],
         task=kanban_card["task"],
         datetime=card_datetime,
-        column_id=kanban_card["column_id"]
+        column_id=kanban_card["column_id"],
+        # Новая карточка встаёт в конец колонки
+        rank=await rank_last(session, KanbanCard, KanbanCard.column_id == kanban_card["column_id"]),
     )
     session.add(new_kanban_card)
-    await session.commit()
-    await session.refresh(new_kanban_card)
+    await session.flush()
+    batch.check_rank(new_kanban_card.rank, new_kanban_card.column_id)
 
     # new_calendar_event = CalendarEvent(
     #     title=f'Task: {kanban_card.task}',
@@ -675,24 +1055,61 @@ async def create_kanban_card(
     # session.add(new_calendar_event)
     # await session.commit()
 
-    await manager.broadcast({"action": "create_card", "kanban_card": KanbanCardResponse.model_validate(new_kanban_card).model_dump(mode='json')})
+    topics = await card_topics(session, new_kanban_card)
+    batch.add(topics, {"action": "create_card", "kanban_card": KanbanCardResponse.model_validate(new_kanban_card)})
 
 
+# Карточки постранично: {"action": "get_cards", "kanban_column_id": ..., "after": <next_cursor>, "limit": ...};
+# next_cursor равен null на последней странице
 async def get_kanban_cards(
     websocket: WebSocket,
-    # limit: int = Query(10, ge=1),
-    # offset: int = Query(0, ge=0),
     # user: User = Depends(current_active_user),
     session: AsyncSession = Depends(get_async_session),
     kanban_column_id: int = None,
+    after: Optional[list] = None,
+    limit: int = KANBAN_PAGE_SIZE,
 ):
-    query = select(KanbanCard)
-    if kanban_column_id:
-        query = query.filter_by(column_id=kanban_column_id)
-    result = await session.execute(query)
-    kanban_card = result.scalars().all()
+    limit = max(1, min(limit, KANBAN_PAGE_SIZE))
+    kanban_card = await page_cards(session, manager.user_id(websocket), kanban_column_id, after, limit)
+    next_cursor = card_cursor(kanban_card[-1]) if len(kanban_card) == limit else None
+
+    await manager.send(websocket, {
+        "action": "get_cards",
+        "kanban_column_id": kanban_column_id,
+        "kanban_cards": [KanbanCardResponse.model_validate(card) for card in kanban_card],
+        "next_cursor": next_cursor,
+    })
+
+
+# Поиск по имени, компании и телефону (префиксный): {"action": "search_cards", "query": "...", "kanban_column_id": ...}
+async def search_kanban_cards(
+    websocket: WebSocket,
+    session: AsyncSession,
+    query: str,
+    kanban_column_id: int = None,
+    limit: int = KANBAN_PAGE_SIZE,
+):
+    limit = max(1, min(limit, KANBAN_PAGE_SIZE))
+    kanban_card = await search_cards(session, manager.user_id(websocket), query, kanban_column_id, limit)
+    await manager.send(websocket, {
+        "action": "search_cards",
+        "query": query,
+        "kanban_cards": [KanbanCardResponse.model_validate(card) for card in kanban_card],
+    })
 
-    await websocket.send_json({"action": "get_cards", "kanban_cards": [KanbanCardCreate.model_validate(card).model_dump_json() for card in kanban_card]})
+
+kanban_cards_router = APIRouter()
+
+
+@kanban_cards_router.get('/kanban/search', response_model=List[KanbanCardResponse])
+async def search_kanban_cards_rest(
+    q: str = Query(..., min_length=1),
+    kanban_column_id: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=KANBAN_PAGE_SIZE),
+    user: User = Depends(current_active_user),
+    session: AsyncSession = Depends(get_async_session)
+):
+    return await search_cards(session, user.id, q, kanban_column_id, limit)
 
 
 # async def get_kanban_card(
@@ -724,18 +1141,27 @@ async def update_kanban_card(
         kanban_card_id: str,
         kanban_card: KanbanCardCreate,
         # user: User = Depends(current_active_user),
-        session: AsyncSession = Depends(get_async_session)
+        session: AsyncSession,
+        batch: KanbanBatch,
 ):
-    query = select(KanbanCard).filter_by(id=kanban_card_id)
-    result = await session.execute(query)
-    new_kanban_card = result.scalars().first()
-    if new_kanban_card:
-        for var, value in vars(kanban_card).items():
+    user_id = manager.user_id(websocket)
+    new_kanban_card = await session.get(KanbanCard, kanban_card_id)
+    if new_kanban_card and await card_visible(session, user_id, new_kanban_card):
+        # При переносе в другую колонку событие получают и старая, и новая доска
+        topics = await card_topics(session, new_kanban_card)
+        # Частичное обновление: проверяются только переданные поля
+        fields = KanbanCardCreate.model_validate({"column_id": new_kanban_card.column_id, **kanban_card})
+        column_id = new_kanban_card.column_id
+        for var, value in fields.model_dump(include=set(kanban_card)).items():
             setattr(new_kanban_card, var, value) if value else None
+        if new_kanban_card.column_id != column_id:
+            if not await column_visible(session, user_id, new_kanban_card.column_id):
+                raise ValueError("Column not found")
+            new_kanban_card.rank = await rank_last(session, KanbanCard, KanbanCard.column_id == new_kanban_card.column_id)
+            batch.check_rank(new_kanban_card.rank, new_kanban_card.column_id)
         session.add(new_kanban_card)
-        await session.commit()
-        await session.refresh(new_kanban_card)
 
+        # Карточка и связанное событие календаря сохраняются одним коммитом
         query = select(CalendarEvent).filter_by(kanban_card_id=kanban_card_id)
         result = await session.execute(query)
         new_calendar_event = result.scalars().first()
@@ -744,36 +1170,58 @@ async def update_kanban_card(
             new_calendar_event.title = f'Task: {new_kanban_card.task}'
             new_calendar_event.start = new_kanban_card.datetime
             new_calendar_event.end = new_kanban_card.datetime + datetime.timedelta(hours=1)
-            await session.commit()
-            await session.refresh(new_calendar_event)
 
-        await manager.broadcast({"action": "update_card", "kanban_card": new_kanban_card})
+        topics |= await column_topics(session, new_kanban_card.column_id)
+        batch.add(topics, {"action": "update_card", "kanban_card": KanbanCardResponse.model_validate(new_kanban_card)})
     else:
-        await websocket.send_json({"error": "Card not found"})
+        raise ValueError("Card not found")
+
+
+# Перенос карточки: {"action": "move_card", "kanban_card_id": ..., "column_id": <колонка, по умолчанию текущая>,
+# "after_id": <карточка выше или null>}. Меняется только rank (и колонка) переносимой карточки
+async def move_kanban_card(
+        websocket: WebSocket,
+        kanban_card_id: str,
+        column_id: Optional[int],
+        after_id: Optional[str],
+        session: AsyncSession,
+        batch: KanbanBatch,
+):
+    user_id = manager.user_id(websocket)
+    kanban_card = await session.get(KanbanCard, kanban_card_id)
+    if kanban_card is None or not await card_visible(session, user_id, kanban_card):
+        raise ValueError("Card not found")
+    topics = await card_topics(session, kanban_card)
+    column_id = column_id or kanban_card.column_id
+    # Назначенная карточка в чужой колонке двигается внутри неё, но не в другие чужие колонки
+    if column_id != kanban_card.column_id and not await column_visible(session, user_id, column_id):
+        raise ValueError("Column not found")
+    kanban_card.rank = await rank_after(session, KanbanCard, after_id, kanban_card.id, KanbanCard.column_id == column_id)
+    kanban_card.column_id = column_id
+    topics |= await column_topics(session, column_id)
+    batch.add(topics, {"action": "move_card", "kanban_card_id": kanban_card.id, "column_id": column_id, "rank": kanban_card.rank})
+    batch.check_rank(kanban_card.rank, column_id)
 
 
 async def delete_kanban_card(
         websocket: WebSocket,
         kanban_card_id: str,
         # user: User = Depends(current_active_user),
-        session: AsyncSession = Depends(get_async_session)
+        session: AsyncSession,
+        batch: KanbanBatch,
 ):
-    query = select(CalendarEvent).filter_by(kanban_card_id=kanban_card_id)
-    result = await session.execute(query)
-    calendar_event = result.scalars().all()
-    if calendar_event:
-        await session.delete(calendar_event)
-        await session.commit()
+    kanban_card = await session.get(KanbanCard, kanban_card_id)
+    if kanban_card and await card_visible(session, manager.user_id(websocket), kanban_card):
+        query = select(CalendarEvent).filter_by(kanban_card_id=kanban_card_id)
+        result = await session.execute(query)
+        for calendar_event in result.scalars().all():
+            await session.delete(calendar_event)
 
-    query = select(KanbanCard).filter_by(id=kanban_card_id)
-    result = await session.execute(query)
-    kanban_card = result.scalars().first()
-    if kanban_card:
+        topics = await card_topics(session, kanban_card)
         await session.delete(kanban_card)
-        await session.commit()
-        await manager.broadcast({"action": "delete_card", "kanban_card_id": kanban_card_id})
+        batch.add(topics, {"action": "delete_card", "kanban_card_id": kanban_card_id})
     else:
-        await websocket.send_json({"error": "Card not found"})
+        raise ValueError("Card not found")
 
 # endregion
 
@@ -951,7 +1399,7 @@ app.include_router(company_router, prefix="/api", tags=["companies"])
 app.include_router(phone_router, prefix="/api", tags=["phone-lists"])
 app.include_router(soundfile_router, prefix="/api", tags=["soundfiles"])
 app.include_router(calendar_router, prefix='/api', tags=['calendars'])
-# app.include_router(kanban_cards_router, prefix='/api', tags=['kanban'])
+app.include_router(kanban_cards_router, prefix='/api', tags=['kanban'])
 app.include_router(calendar_envents_router, prefix='/api', tags=['calendar'])
 
 app.include_router(
@@ -988,7 +1436,17 @@ app.include_router(
 #     tags=["auth"],
 # )
 
-app.mount("/files", StaticFiles(directory="files"), name="files")
+class PublicFiles(StaticFiles):
+    # Хранилище звуков (files/blobs) отдаётся только через /sound-files/{id}/audio с проверкой владельца
+    hidden = os.path.relpath(SOUND_BLOBS_DIRECTORY, "files")
+
+    def lookup_path(self, path: str):
+        if os.path.normcase(path).split(os.sep)[0] == os.path.normcase(self.hidden):
+            return "", None
+        return super().lookup_path(path)
+
+
+app.mount("/files", PublicFiles(directory="files"), name="files")
 
 @app.get("/authenticated-route")
 async def authenticated_route(user: User = Depends(current_active_user)):
@@ -0,0 +1,88 @@
+from typing import Dict, Optional
+
+import httpx
+from starlette.config import Config
+
+config = Config('.env')
+
+ARI_BASE_URL = config('ARI_BASE_URL')
+ARI_USERNAME = config('ARI_USERNAME')
+ARI_PASSWORD = config('ARI_PASSWORD')
+
+ARI_MAX_CONNECTIONS = config('ARI_MAX_CONNECTIONS', cast=int, default=200)
+ARI_KEEPALIVE_CONNECTIONS = config('ARI_KEEPALIVE_CONNECTIONS', cast=int, default=50)
+ARI_CONNECT_TIMEOUT = config('ARI_CONNECT_TIMEOUT', cast=float, default=3.0)
+ARI_REQUEST_TIMEOUT = config('ARI_REQUEST_TIMEOUT', cast=float, default=10.0)
+
+
+class AriClient:
+    """Async client for the Asterisk REST Interface.
+
+    One instance holds one keep-alive connection pool, so every call placed by
+    the process reuses the same TCP connections instead of opening a new one
+    per request.
+    """
+
+    def __init__(self, base_url: str, username: str, password: str):
+        self.base_url = base_url.rstrip('/')
+        self.username = username
+        self.password = password
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def open(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                auth=(self.username, self.password),
+                limits=httpx.Limits(
+                    max_connections=ARI_MAX_CONNECTIONS,
+                    max_keepalive_connections=ARI_KEEPALIVE_CONNECTIONS,
+                ),
+                timeout=httpx.Timeout(ARI_REQUEST_TIMEOUT, connect=ARI_CONNECT_TIMEOUT),
+            )
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            raise RuntimeError("ARI client is not opened")
+        return self._client
+
+    async def originate(
+        self,
+        endpoint: str,
+        extension: str,
+        context: str,
+        variables: Optional[Dict[str, str]] = None,
+        timeout: int = 30,
+        channel_id: Optional[str] = None,
+    ) -> httpx.Response:
+        """Originate a channel (POST /channels)"""
+        params = {
+            "endpoint": endpoint,
+            "extension": extension,
+            "context": context,
+            "timeout": timeout,
+        }
+        if channel_id:
+            params["channelId"] = channel_id
+        return await self.client.post(
+            "/channels",
+            params=params,
+            json={"variables": variables or {}},
+        )
+
+    async def list_channels(self) -> httpx.Response:
+        """List active channels (GET /channels)"""
+        return await self.client.get("/channels")
+
+    async def hangup(self, channel_id: str) -> httpx.Response:
+        """Hang up a channel (DELETE /channels/{channel_id})"""
+        return await self.client.delete(f"/channels/{channel_id}")
+
+
+ari_client = AriClient(ARI_BASE_URL, ARI_USERNAME, ARI_PASSWORD)
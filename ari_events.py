@@ -0,0 +1,165 @@
+import asyncio
+import datetime
+import json
+from typing import Callable, Dict, Optional
+from urllib.parse import urlencode
+
+import websockets
+from starlette.config import Config
+
+from ari import ARI_BASE_URL, ARI_USERNAME, ARI_PASSWORD, ari_client
+from call_log import CALL_ANSWERED, call_log, hangup_status
+from pacer import CompanyPacer, PACER_SLOT_SECONDS
+
+config = Config('.env')
+
+ARI_APP = config('ARI_APP', default='autocall')
+# Safety net for channels whose hangup event was never received
+ARI_CHANNEL_MAX_SECONDS = config('ARI_CHANNEL_MAX_SECONDS', cast=float, default=600.0)
+ARI_RECONNECT_DELAY = config('ARI_RECONNECT_DELAY', cast=float, default=1.0)
+ARI_RECONNECT_MAX_DELAY = 30.0
+
+
+def events_url() -> str:
+    base = ARI_BASE_URL.rstrip('/')
+    if base.startswith('https://'):
+        base = 'wss://' + base[len('https://'):]
+    elif base.startswith('http://'):
+        base = 'ws://' + base[len('http://'):]
+    query = urlencode({
+        "app": ARI_APP,
+        "subscribeAll": "true",
+        "api_key": f"{ARI_USERNAME}:{ARI_PASSWORD}",
+    })
+    return f"{base}/events?{query}"
+
+
+class TrackedChannel:
+    def __init__(self, channel_id: str, pacer: CompanyPacer, timer: asyncio.TimerHandle,
+                 on_end: Optional[Callable[[Optional[str]], None]] = None):
+        self.channel_id = channel_id
+        self.pacer = pacer
+        self.timer = timer
+        self.on_end = on_end
+        self.answered = False
+        self.reaction = None
+        # Tracked while the socket was down: held for PACER_SLOT_SECONDS until the next reconcile
+        self.provisional = False
+
+
+class AriEventListener:
+    """Consumes the ARI event WebSocket and keeps track of live channels.
+
+    Every originated channel is registered with ``track()`` before the
+    request is sent, holding one line of its company's pacer. Answer, DTMF
+    and hangup events update its ``call_log`` row, and the line is freed as
+    soon as ``ChannelDestroyed`` arrives for it. While the socket is
+    down, lines fall back to the fixed ``PACER_SLOT_SECONDS`` hold; once it
+    is back, channels still alive are held until they end again.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.connected = False
+        self._channels: Dict[str, TrackedChannel] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self.connected = False
+
+    def track(self, channel_id: str, pacer: CompanyPacer, on_end: Optional[Callable[[Optional[str]], None]] = None):
+        """Hold a line of ``pacer`` until the channel is destroyed.
+
+        ``on_end`` is called with the final call status once the channel is
+        gone, or with None if its end was never observed.
+        """
+        timeout = ARI_CHANNEL_MAX_SECONDS if self.connected else PACER_SLOT_SECONDS
+        channel = TrackedChannel(channel_id, pacer, self._expire_after(channel_id, timeout), on_end)
+        channel.provisional = not self.connected
+        self._channels[channel_id] = channel
+
+    def _expire_after(self, channel_id: str, timeout: float) -> asyncio.TimerHandle:
+        return asyncio.get_running_loop().call_later(
+            timeout, lambda: asyncio.ensure_future(self.finish(channel_id))
+        )
+
+    async def finish(self, channel_id: str, status: Optional[str] = None) -> bool:
+        """Free the line held by a channel; return False if it was not tracked"""
+        channel = self._channels.pop(channel_id, None)
+        if channel is None:
+            return False
+        channel.timer.cancel()
+        await channel.pacer.release()
+        if channel.on_end is not None:
+            channel.on_end(status)
+        return True
+
+    async def _run(self):
+        delay = ARI_RECONNECT_DELAY
+        while True:
+            try:
+                async with websockets.connect(self.url) as ws:
+                    self.connected = True
+                    delay = ARI_RECONNECT_DELAY
+                    await self._reconcile()
+                    async for message in ws:
+                        await self.handle(json.loads(message))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"ARI events connection lost: {e}")
+            self.connected = False
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, ARI_RECONNECT_MAX_DELAY)
+
+    async def _reconcile(self):
+        """Release channels that ended while the socket was down and hold the others until they end"""
+        if not self._channels:
+            return
+        alive = None
+        try:
+            response = await ari_client.list_channels()
+            response.raise_for_status()
+            alive = {channel["id"] for channel in response.json()}
+        except Exception as e:
+            # Keep every channel: freeing a line too late only slows dialing, too early exceeds com_limit
+            print(f"ARI channel reconcile failed: {e}")
+        for channel_id, channel in list(self._channels.items()):
+            if alive is not None and channel_id not in alive:
+                await self.finish(channel_id)
+            elif channel.provisional:
+                channel.timer.cancel()
+                channel.timer = self._expire_after(channel_id, ARI_CHANNEL_MAX_SECONDS)
+                channel.provisional = False
+
+    async def handle(self, event: dict):
+        event_type = event.get("type")
+        channel_id = event.get("channel", {}).get("id")
+        channel = self._channels.get(channel_id)
+        if channel is None:
+            return
+
+        if event_type == "ChannelStateChange":
+            if event["channel"].get("state") == "Up" and not channel.answered:
+                channel.answered = True
+                call_log.update(channel_id, status=CALL_ANSWERED, answered_at=datetime.datetime.utcnow())
+        elif event_type == "ChannelDtmfReceived":
+            if channel.reaction is None:
+                channel.reaction = event.get("digit")
+                call_log.update(channel_id, reaction=channel.reaction)
+        elif event_type == "ChannelDestroyed":
+            cause = event.get("cause")
+            status = hangup_status(cause, channel.answered)
+            call_log.update(channel_id, status=status, hangup_cause=cause, ended_at=datetime.datetime.utcnow())
+            await self.finish(channel_id, status)
+
+
+ari_events = AriEventListener(events_url())
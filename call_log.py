@@ -0,0 +1,180 @@
+import asyncio
+import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import bindparam, func, insert, select, update
+from starlette.config import Config
+
+from db import async_session_maker
+from models import CallAttempt
+
+config = Config('.env')
+
+CALL_LOG_FLUSH_INTERVAL = config('CALL_LOG_FLUSH_INTERVAL', cast=float, default=0.5)
+CALL_LOG_BATCH_SIZE = config('CALL_LOG_BATCH_SIZE', cast=int, default=500)
+
+CALL_ORIGINATED = "originated"
+CALL_ANSWERED = "answered"
+CALL_COMPLETED = "completed"
+CALL_BUSY = "busy"
+CALL_NO_ANSWER = "no_answer"
+CALL_FAILED = "failed"
+
+# Q.850 hangup causes reported by Asterisk
+CAUSE_NORMAL_CLEARING = 16
+CAUSE_USER_BUSY = 17
+CAUSE_NO_USER_RESPONSE = 18
+CAUSE_NO_ANSWER = 19
+
+
+def hangup_status(cause: Optional[int], answered: bool) -> str:
+    if answered:
+        return CALL_COMPLETED
+    if cause == CAUSE_USER_BUSY:
+        return CALL_BUSY
+    if cause in (CAUSE_NORMAL_CLEARING, CAUSE_NO_USER_RESPONSE, CAUSE_NO_ANSWER):
+        return CALL_NO_ANSWER
+    return CALL_FAILED
+
+
+class CallLogWriter:
+    """Buffers call attempt rows and writes them in bulk.
+
+    New attempts are collected as INSERT parameter sets and status changes as
+    UPDATE parameter sets keyed by channel id; both are written with one
+    executemany each and a single commit per flush. A flush happens every
+    CALL_LOG_FLUSH_INTERVAL seconds or as soon as CALL_LOG_BATCH_SIZE rows
+    are waiting. The rows of a flush that fails are kept for the next one.
+    """
+
+    def __init__(self):
+        self._inserts: Dict[str, dict] = {}
+        self._updates: Dict[str, dict] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, campaign_id: int, company_id: int, phone: str, channel_id: str):
+        self._inserts[channel_id] = {
+            "campaign_id": campaign_id,
+            "company_id": company_id,
+            "phone": phone,
+            "channel_id": channel_id,
+            "status": CALL_ORIGINATED,
+            "reaction": None,
+            "hangup_cause": None,
+            "created_at": datetime.datetime.utcnow(),
+            "answered_at": None,
+            "ended_at": None,
+        }
+        self._maybe_flush()
+
+    def update(self, channel_id: str, **fields):
+        pending = self._inserts.get(channel_id)
+        if pending is not None:
+            pending.update(fields)
+        else:
+            self._updates.setdefault(channel_id, {}).update(fields)
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if len(self._inserts) + len(self._updates) >= CALL_LOG_BATCH_SIZE:
+            self._wakeup.set()
+
+    async def flush(self):
+        if not self._inserts and not self._updates:
+            return
+        inserts, self._inserts = list(self._inserts.values()), {}
+        updates, self._updates = self._updates, {}
+
+        # executemany needs the same columns in every parameter set
+        update_groups: Dict[tuple, List[dict]] = {}
+        for channel_id, fields in updates.items():
+            update_groups.setdefault(tuple(sorted(fields)), []).append({"b_channel_id": channel_id, **fields})
+
+        table = CallAttempt.__table__
+        try:
+            async with async_session_maker() as session:
+                if inserts:
+                    await session.execute(insert(table), inserts)
+                for columns, rows in update_groups.items():
+                    query = (
+                        update(table)
+                        .where(table.c.channel_id == bindparam("b_channel_id"))
+                        .values({column: bindparam(column) for column in columns})
+                    )
+                    await session.execute(query, rows)
+                await session.commit()
+        except BaseException:
+            # Nothing was committed: the rows go back and are written by the next flush
+            self._requeue(inserts, updates)
+            raise
+
+    def _requeue(self, inserts: List[dict], updates: Dict[str, dict]):
+        """Put back the rows of a failed flush under the changes made to them while it ran"""
+        for row in inserts:
+            # An attempt updated during the flush had its fields buffered as an UPDATE
+            row.update(self._updates.pop(row["channel_id"], {}))
+        self._inserts = {**{row["channel_id"]: row for row in inserts}, **self._inserts}
+        for channel_id, fields in updates.items():
+            self._updates[channel_id] = {**fields, **self._updates.get(channel_id, {})}
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=CALL_LOG_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Call log flush failed: {e}")
+
+
+call_log = CallLogWriter()
+
+
+async def count_calls_today(session, company_id: int) -> int:
+    """Calls placed by a company since local midnight"""
+    midnight = datetime.datetime.combine(datetime.date.today(), datetime.time(0, 0))
+    since = midnight.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    query = select(func.count()).select_from(CallAttempt).where(
+        CallAttempt.company_id == company_id,
+        CallAttempt.created_at >= since,
+    )
+    result = await session.execute(query)
+    return result.scalar_one()
+
+
+async def campaign_stats(session, campaign_id: int) -> dict:
+    query = (
+        select(CallAttempt.status, func.count())
+        .where(CallAttempt.campaign_id == campaign_id)
+        .group_by(CallAttempt.status)
+    )
+    statuses = dict((await session.execute(query)).all())
+
+    query = (
+        select(CallAttempt.reaction, func.count())
+        .where(CallAttempt.campaign_id == campaign_id, CallAttempt.reaction.is_not(None))
+        .group_by(CallAttempt.reaction)
+    )
+    reactions = dict((await session.execute(query)).all())
+
+    return {
+        "campaign_id": campaign_id,
+        "total": sum(statuses.values()),
+        "statuses": statuses,
+        "reactions": reactions,
+    }
@@ -0,0 +1,416 @@
+import asyncio
+import datetime
+import json
+import os
+import time
+from collections import deque
+from typing import Dict, Optional
+from uuid import uuid4
+
+from sqlalchemy import or_, select, update
+from starlette.config import Config
+
+from ari import ari_client
+from ari_events import ari_events
+from call_log import CALL_FAILED, call_log, count_calls_today
+from retries import RETRY_STATUSES, retry_queue
+from db import async_session_maker
+from models import CampaignModel, CompanyModel, PhoneListModel
+from pacer import CompanyPacer, pacers
+from phone_lists import iter_numbers
+from phones import dial_endpoint
+from schemas import CallFile
+
+config = Config('.env')
+
+CAMPAIGN_QUEUED = "queued"
+CAMPAIGN_RUNNING = "running"
+CAMPAIGN_PAUSED = "paused"
+CAMPAIGN_CANCELLED = "cancelled"
+CAMPAIGN_COMPLETED = "completed"
+CAMPAIGN_FAILED = "failed"
+
+# How often a running campaign persists its cursor, in seconds
+CAMPAIGN_COMMIT_INTERVAL = 1.0
+# How often a running campaign looks for retries that became due, in seconds
+CAMPAIGN_RETRY_POLL_INTERVAL = 5.0
+# How long a worker's claim on a campaign holds without being renewed, in seconds;
+# a campaign left by a worker that died is picked up by the next sweep after that
+CAMPAIGN_LEASE = config('CAMPAIGN_LEASE', cast=float, default=30.0)
+# How often every worker looks for queued or running campaigns nobody holds a live claim on, in seconds
+CAMPAIGN_SWEEP_INTERVAL = config('CAMPAIGN_SWEEP_INTERVAL', cast=float, default=CAMPAIGN_LEASE)
+# Identifies this process in campaigns.owner
+WORKER_ID = uuid4().hex
+
+
+class CampaignReleased(Exception):
+    """The campaign was paused, cancelled or claimed by another worker while this one was dialing it"""
+
+
+def lease_end() -> datetime.datetime:
+    return datetime.datetime.utcnow() + datetime.timedelta(seconds=CAMPAIGN_LEASE)
+
+
+def call_variables(sound_file: str, reaction) -> Dict[str, str]:
+    """Channel variables shared by every call of a campaign, built once when it starts.
+
+    SOUND_FILE has no extension so Asterisk picks the pre-rendered variant
+    (.ulaw, .alaw, .sln, .g722 or .wav) matching the channel codec.
+    """
+    return {
+        "SOUND_FILE": os.path.splitext(os.path.abspath(sound_file))[0],
+        "REACTION": json.dumps(reaction)
+    }
+
+
+async def make_call(phone_number, variables: Dict[str, str], channel_id=None):
+    """Make a single call request; phone_number is already normalized by phones.normalize_phones"""
+    return await ari_client.originate(
+        endpoint=dial_endpoint(phone_number),
+        extension='55555',
+        context='Autocall',
+        variables=variables,
+        timeout=30,
+        channel_id=channel_id,
+    )
+
+
+async def company_list_size(session, company: CompanyModel) -> int:
+    phone_list = await session.get(PhoneListModel, company.phones_id) if company.phones_id else None
+    if phone_list is None:
+        return 0
+    return phone_list.size or 0
+
+
+class CampaignScheduler:
+    """Runs dialing campaigns as background asyncio tasks.
+
+    Campaign state lives in the ``campaigns`` table: the task persists its
+    cursor as it goes, so pausing, cancelling or restarting the server never
+    loses progress. Campaigns left ``running`` are picked up again by
+    ``restore()`` on startup, and by a sweep every CAMPAIGN_SWEEP_INTERVAL
+    seconds once the claim of the worker that ran them has expired.
+
+    Several workers can share the table: a worker dials a campaign only after
+    claiming it with an atomic UPDATE (``owner``, ``lease_until``), and keeps
+    renewing the claim while it runs. Renewing fails once the campaign is
+    paused or cancelled, whichever worker handled the request, and the
+    campaign then stops here too.
+
+    Call starts are paced by the company's ``CompanyPacer`` and each line is
+    handed back when ``ari_events`` sees the channel end. Busy, unanswered
+    and failed calls go to the ``retry_queue``; due retries are dialed ahead
+    of fresh numbers, and the campaign completes once both are exhausted.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._live: Dict[int, int] = {}
+        self._calls = set()
+        # Status a campaign is being stopped with, written by its task together with the release of its claim
+        self._stopping: Dict[int, str] = {}
+        self._sweeper: Optional[asyncio.Task] = None
+
+    def is_active(self, campaign_id: int) -> bool:
+        task = self._tasks.get(campaign_id)
+        return task is not None and not task.done()
+
+    async def submit(self, session, company: CompanyModel, callfile: CallFile,
+                     user_id: int) -> Optional[CampaignModel]:
+        total = await company_list_size(session, company)
+        if not total:
+            return None
+        campaign = CampaignModel(
+            company_id=company.id,
+            user_id=user_id,
+            status=CAMPAIGN_QUEUED,
+            sound_file=callfile.filepath,
+            reaction=callfile.reaction,
+            cursor=0,
+            total=total,
+            dialed=0,
+            retried=0,
+            max_retries=callfile.max_retries,
+            retry_delay=callfile.retry_delay,
+            retry_backoff=callfile.retry_backoff,
+        )
+        session.add(campaign)
+        await session.commit()
+        await session.refresh(campaign)
+        self.start(campaign.id)
+        return campaign
+
+    def start(self, campaign_id: int):
+        if self.is_active(campaign_id):
+            return
+        task = asyncio.create_task(self._run(campaign_id))
+        self._tasks[campaign_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(campaign_id, None))
+
+    async def pause(self, session, campaign: CampaignModel) -> CampaignModel:
+        return await self._stop(session, campaign, CAMPAIGN_PAUSED)
+
+    async def cancel(self, session, campaign: CampaignModel) -> CampaignModel:
+        return await self._stop(session, campaign, CAMPAIGN_CANCELLED)
+
+    async def resume(self, session, campaign: CampaignModel) -> CampaignModel:
+        campaign.status = CAMPAIGN_QUEUED
+        await session.commit()
+        await session.refresh(campaign)
+        self.start(campaign.id)
+        return campaign
+
+    async def _stop(self, session, campaign: CampaignModel, status: str) -> CampaignModel:
+        task = self._tasks.get(campaign.id)
+        if task is not None:
+            # The task saves its progress in its own session while we wait: hold no connection
+            # (the writer would deadlock it) and read its result in a new transaction
+            await session.commit()
+            # The task releases the claim and sets the status in one transaction: were they
+            # committed apart, a sweep in between would take the campaign up again
+            self._stopping[campaign.id] = status
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            self._stopping.pop(campaign.id, None)
+        await session.refresh(campaign)
+        campaign.status = status
+        # Releasing the claim also stops the campaign in the worker dialing it, if that is another one
+        campaign.owner = None
+        campaign.lease_until = None
+        await session.commit()
+        await session.refresh(campaign)
+        return campaign
+
+    async def restore(self):
+        """Restart campaigns that were in progress when the server stopped, then keep sweeping for abandoned ones"""
+        await self.sweep()
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_periodically())
+
+    async def sweep(self):
+        """Start queued or running campaigns that no worker holds a live claim on.
+
+        Covers campaigns of a worker that died (including this one before a
+        restart): their lease is still live right after the crash, so they
+        are only taken once it expires.
+        """
+        now = datetime.datetime.utcnow()
+        async with async_session_maker() as session:
+            query = select(CampaignModel.id).where(
+                CampaignModel.status.in_([CAMPAIGN_QUEUED, CAMPAIGN_RUNNING]),
+                or_(CampaignModel.owner.is_(None), CampaignModel.owner == WORKER_ID, CampaignModel.lease_until < now),
+            )
+            result = await session.execute(query)
+            campaign_ids = result.scalars().all()
+        for campaign_id in campaign_ids:
+            self.start(campaign_id)
+
+    async def _sweep_periodically(self):
+        while True:
+            await asyncio.sleep(CAMPAIGN_SWEEP_INTERVAL)
+            try:
+                await self.sweep()
+            except Exception as e:
+                print(f"Campaign sweep failed: {e}")
+
+    async def shutdown(self):
+        """Stop the tasks but keep their status so restore() picks them up"""
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _claim(self, session, campaign_id: int) -> bool:
+        """Take a queued or running campaign unless another worker holds a live claim on it"""
+        now = datetime.datetime.utcnow()
+        query = (
+            update(CampaignModel)
+            .where(
+                CampaignModel.id == campaign_id,
+                CampaignModel.status.in_([CAMPAIGN_QUEUED, CAMPAIGN_RUNNING]),
+                or_(CampaignModel.owner.is_(None), CampaignModel.owner == WORKER_ID, CampaignModel.lease_until < now),
+            )
+            .values(owner=WORKER_ID, lease_until=lease_end(), status=CAMPAIGN_RUNNING)
+            .execution_options(synchronize_session=False)
+        )
+        result = await session.execute(query)
+        await session.commit()
+        return result.rowcount == 1
+
+    async def _renew(self, session, campaign_id: int) -> bool:
+        """Extend the claim; False once the campaign is no longer running under this worker"""
+        query = (
+            update(CampaignModel)
+            .where(CampaignModel.id == campaign_id, CampaignModel.owner == WORKER_ID,
+                   CampaignModel.status == CAMPAIGN_RUNNING)
+            .values(lease_until=lease_end())
+            .execution_options(synchronize_session=False)
+        )
+        result = await session.execute(query)
+        await session.commit()
+        return result.rowcount == 1
+
+    async def _release(self, session, campaign_id: int, **values):
+        """Give up the claim, setting ``values`` only if this worker still holds a running campaign"""
+        query = update(CampaignModel).where(CampaignModel.id == campaign_id, CampaignModel.owner == WORKER_ID)
+        if values:
+            query = query.where(CampaignModel.status == CAMPAIGN_RUNNING)
+        query = query.values(owner=None, lease_until=None, **values).execution_options(synchronize_session=False)
+        await session.execute(query)
+        await session.commit()
+
+    async def _hand_back(self, session, campaign: CampaignModel, retries):
+        """Stop dialing here, with the status _stop asked for; otherwise (a shutdown, or a
+        pause through another worker) the status is left as it is"""
+        # Keep the cursor of calls already handed to Asterisk and the retries not dialed yet
+        values = {"cursor": campaign.cursor, "dialed": campaign.dialed, "retried": campaign.retried}
+        status = self._stopping.pop(campaign.id, None)
+        if status is not None:
+            values["status"] = status
+        # Being cancelled may have interrupted a commit or _renew holding the only writer
+        # connection: end that transaction before another session waits for it. The campaign
+        # is detached first so calls still live keep reading its settings after the rollback
+        session.expunge(campaign)
+        await session.rollback()
+        retry_queue.restore(campaign.id, list(retries))
+        await retry_queue.flush()
+        query = (
+            update(CampaignModel)
+            .where(CampaignModel.id == campaign.id, or_(CampaignModel.owner.is_(None), CampaignModel.owner == WORKER_ID))
+            .values(owner=None, lease_until=None, **values)
+            .execution_options(synchronize_session=False)
+        )
+        await session.execute(query)
+        await session.commit()
+
+    async def _keep_claim(self, campaign_id: int, run: asyncio.Task):
+        """Renew the claim while the campaign waits on the pacer or for retries; stop it once lost"""
+        while True:
+            await asyncio.sleep(CAMPAIGN_LEASE / 3)
+            try:
+                async with async_session_maker() as session:
+                    held = await self._renew(session, campaign_id)
+            except Exception as e:
+                print(f"Campaign {campaign_id}: renewing the claim failed: {e}")
+                continue
+            if not held:
+                run.cancel()
+                return
+
+    async def _run(self, campaign_id: int):
+        async with async_session_maker() as session:
+            if not await self._claim(session, campaign_id):
+                return
+            campaign = await session.get(CampaignModel, campaign_id)
+            if campaign is None:
+                return
+            company = await session.get(CompanyModel, campaign.company_id)
+            if company is None:
+                await self._release(session, campaign_id, status=CAMPAIGN_FAILED, error="Company not found")
+                return
+            total = await company_list_size(session, company)
+            pacer = pacers.get(company)
+            pacer.seed_day_count(await count_calls_today(session, company.id))
+            campaign.total = total
+            # The session is only used to persist progress; every use ends with a
+            # commit so no transaction stays open while waiting on the pacer
+            await session.commit()
+
+            variables = call_variables(campaign.sound_file, campaign.reaction)
+            retries = deque()
+            keeper = asyncio.create_task(self._keep_claim(campaign_id, asyncio.current_task()))
+            try:
+                # The cursor is the id of the last phone_numbers row handed to the dialer
+                fresh = iter_numbers(company.phones_id, after=campaign.cursor or 0)
+                next_phone = await anext(fresh, None)
+                last_commit = time.monotonic()
+                next_retry_poll = 0.0
+                while True:
+                    if not retries and time.monotonic() >= next_retry_poll:
+                        retries.extend(await retry_queue.claim_due(campaign.id))
+                        next_retry_poll = time.monotonic() + CAMPAIGN_RETRY_POLL_INTERVAL
+
+                    if not retries and next_phone is None:
+                        if await self._exhausted(campaign.id):
+                            break
+                        await asyncio.sleep(CAMPAIGN_RETRY_POLL_INTERVAL)
+                        next_retry_poll = 0.0
+                        continue
+
+                    await pacer.acquire()
+                    if retries:
+                        phone, attempt, retry_id = retries.popleft()
+                    else:
+                        (campaign.cursor, phone), attempt, retry_id = next_phone, 0, None
+                    self._live[campaign.id] = self._live.get(campaign.id, 0) + 1
+                    call = asyncio.create_task(self._dial(campaign, pacer, variables, phone, attempt, retry_id))
+                    self._calls.add(call)
+                    call.add_done_callback(self._calls.discard)
+                    if attempt:
+                        campaign.retried += 1
+                    else:
+                        campaign.dialed += 1
+                        next_phone = await anext(fresh, None)
+
+                    if time.monotonic() - last_commit >= CAMPAIGN_COMMIT_INTERVAL:
+                        await session.commit()
+                        # Paused or cancelled through another worker: stop before the next call
+                        if not await self._renew(session, campaign_id):
+                            raise CampaignReleased()
+                        last_commit = time.monotonic()
+
+                await session.commit()
+                await self._release(session, campaign_id, status=CAMPAIGN_COMPLETED)
+            except CampaignReleased:
+                await self._hand_back(session, campaign, retries)
+            except asyncio.CancelledError:
+                await self._hand_back(session, campaign, retries)
+                raise
+            except Exception as e:
+                print(f"Campaign {campaign_id} failed: {e}")
+                session.expunge(campaign)
+                await session.rollback()
+                await self._release(session, campaign_id, status=CAMPAIGN_FAILED, error=str(e))
+            finally:
+                keeper.cancel()
+
+    async def _exhausted(self, campaign_id: int) -> bool:
+        """True when no call of the campaign is live and no retry is queued"""
+        if self._live.get(campaign_id):
+            return False
+        return not await retry_queue.has_pending(campaign_id)
+
+    async def _dial(self, campaign: CampaignModel, pacer: CompanyPacer, variables: Dict[str, str], phone, attempt: int,
+                    retry_id: Optional[int] = None):
+        def call_ended(status):
+            self._live[campaign.id] -= 1
+            if status in RETRY_STATUSES:
+                retry_queue.schedule(campaign, phone, attempt + 1, status)
+
+        # Track the channel before originating so an early hangup is not missed
+        channel_id = str(uuid4())
+        ari_events.track(channel_id, pacer, call_ended)
+        call_log.record(campaign.id, campaign.company_id, phone, channel_id)
+        try:
+            response = await make_call(phone, variables, channel_id)
+            response.raise_for_status()
+        except Exception as e:
+            print(f"Campaign {campaign.id}: call to {phone} failed: {e}")
+            call_log.update(channel_id, status=CALL_FAILED, ended_at=datetime.datetime.utcnow())
+            await ari_events.finish(channel_id, CALL_FAILED)
+        # The attempt is made (a failure above scheduled the next one): the claimed retry can go
+        if retry_id is not None:
+            retry_queue.done(retry_id, attempt)
+
+
+scheduler = CampaignScheduler()
+
+
+async def get_campaign(session, campaign_id: int, user_id: int) -> Optional[CampaignModel]:
+    query = select(CampaignModel).filter_by(id=campaign_id, user_id=user_id)
+    result = await session.execute(query)
+    return result.scalars().first()
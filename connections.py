@@ -0,0 +1,179 @@
+import asyncio
+from typing import Any, Dict, Iterable, Optional, Set
+
+from fastapi import WebSocket
+from pydantic_core import to_json
+from starlette.config import Config
+
+from pubsub import create_broker
+
+config = Config('.env')
+
+# Messages waiting for one client; a client that falls this far behind is disconnected
+WS_QUEUE_SIZE = config('WS_QUEUE_SIZE', cast=int, default=256)
+# A single send taking longer than this means the client is gone or stuck
+WS_SEND_TIMEOUT = config('WS_SEND_TIMEOUT', cast=float, default=5.0)
+# Close code sent to evicted clients: "try again later"
+WS_CLOSE_SLOW_CONSUMER = 1013
+
+
+def encode(message: Any) -> str:
+    return to_json(message).decode()
+
+
+class Connection:
+    def __init__(self, websocket: WebSocket, user_id: Optional[int] = None):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.topics: Set[str] = set()
+        self.queue: asyncio.Queue = asyncio.Queue(WS_QUEUE_SIZE)
+        self.writer: Optional[asyncio.Task] = None
+
+
+class ConnectionManager:
+    """WebSocket clients and fan-out of messages to them.
+
+    Every connection has a bounded outbound queue drained by its own writer
+    task, so publishing only enqueues and never waits on a socket: a slow
+    client delays nobody else. A client whose queue overflows or whose send
+    times out or fails is evicted.
+
+    Messages are encoded to a JSON text frame once, whatever the number of
+    clients; they may contain Pydantic models, which are serialized by
+    their schema.
+
+    Clients subscribe to topics; publish() looks the topics up in an index
+    so an event only costs work for the clients subscribed to it.
+
+    Events are also handed to the broker, which forwards them to the
+    managers of the other workers (see pubsub.py); each worker delivers
+    them to its own subscribers.
+    """
+
+    def __init__(self, broker=None):
+        self.broker = broker if broker is not None else create_broker()
+        self._connections: Dict[WebSocket, Connection] = {}
+        self._topics: Dict[str, Set[Connection]] = {}
+        self.sent = 0
+        self.evicted = 0
+        self.peak_queue_depth = 0
+        self._closing = set()
+
+    async def start(self):
+        await self.broker.start(self._deliver)
+
+    async def stop(self):
+        await self.broker.stop()
+
+    async def connect(self, websocket: WebSocket, user_id: Optional[int] = None):
+        await websocket.accept()
+        connection = Connection(websocket, user_id)
+        connection.writer = asyncio.create_task(self._write(connection))
+        self._connections[websocket] = connection
+
+    def disconnect(self, websocket: WebSocket):
+        connection = self._connections.get(websocket)
+        if connection is None:
+            return
+        self.unsubscribe(websocket, list(connection.topics))
+        del self._connections[websocket]
+        if connection.writer is not asyncio.current_task():
+            connection.writer.cancel()
+
+    def user_id(self, websocket: WebSocket) -> Optional[int]:
+        connection = self._connections.get(websocket)
+        return connection.user_id if connection is not None else None
+
+    def topics(self, websocket: WebSocket) -> Set[str]:
+        connection = self._connections.get(websocket)
+        return set(connection.topics) if connection is not None else set()
+
+    def subscribe(self, websocket: WebSocket, topics: Iterable[str]):
+        connection = self._connections.get(websocket)
+        if connection is None:
+            return
+        for topic in topics:
+            connection.topics.add(topic)
+            self._topics.setdefault(topic, set()).add(connection)
+
+    def unsubscribe(self, websocket: WebSocket, topics: Iterable[str]):
+        connection = self._connections.get(websocket)
+        if connection is None:
+            return
+        for topic in topics:
+            connection.topics.discard(topic)
+            subscribers = self._topics.get(topic)
+            if subscribers is not None:
+                subscribers.discard(connection)
+                if not subscribers:
+                    del self._topics[topic]
+
+    async def send(self, websocket: WebSocket, message: Any):
+        """Queue a message for one client"""
+        connection = self._connections.get(websocket)
+        if connection is not None:
+            self._enqueue(connection, encode(message))
+
+    async def publish(self, topics: Iterable[str], message: Any):
+        """Queue a message for the clients of every worker subscribed to any of the topics, once per client"""
+        topics = list(topics)
+        frame = encode(message)
+        await self._deliver(topics, frame)
+        await self.broker.publish(topics, frame)
+
+    async def _deliver(self, topics: Iterable[str], frame: str):
+        subscribers = set()
+        for topic in topics:
+            subscribers.update(self._topics.get(topic, ()))
+        for connection in subscribers:
+            self._enqueue(connection, frame)
+
+    def _enqueue(self, connection: Connection, frame: str):
+        try:
+            connection.queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            self._evict(connection, "outbound queue full")
+            return
+        self.peak_queue_depth = max(self.peak_queue_depth, connection.queue.qsize())
+
+    async def _write(self, connection: Connection):
+        while True:
+            frame = await connection.queue.get()
+            try:
+                await asyncio.wait_for(connection.websocket.send_text(frame), WS_SEND_TIMEOUT)
+            except Exception as e:
+                self._evict(connection, f"send failed: {e!r}")
+                return
+            self.sent += 1
+
+    def _evict(self, connection: Connection, reason: str):
+        if self._connections.get(connection.websocket) is not connection:
+            return
+        print(f"Evicting WebSocket client: {reason}")
+        self.evicted += 1
+        self.disconnect(connection.websocket)
+        # Closing may itself wait on the stuck client, so it runs in the background
+        task = asyncio.create_task(self._close(connection.websocket))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def _close(self, websocket: WebSocket):
+        try:
+            await asyncio.wait_for(websocket.close(code=WS_CLOSE_SLOW_CONSUMER), WS_SEND_TIMEOUT)
+        except Exception:
+            pass
+
+    def metrics(self) -> Dict[str, int]:
+        depths = [connection.queue.qsize() for connection in self._connections.values()]
+        return {
+            "connections": len(depths),
+            "topics": len(self._topics),
+            "queued": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "peak_queue_depth": self.peak_queue_depth,
+            "sent": self.sent,
+            "evicted": self.evicted,
+        }
+
+
+manager = ConnectionManager()
@@ -3,21 +3,114 @@ from typing import AsyncGenerator
 from fastapi import Depends
 from fastapi_users.db import SQLAlchemyBaseUserTableUUID, SQLAlchemyUserDatabase
 from fastapi_users_db_sqlalchemy import SQLAlchemyBaseUserTable
-from sqlalchemy import Column, Integer
+from sqlalchemy import Column, Integer, event, inspect, text
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
-from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.orm import DeclarativeBase, Session
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.sql.dml import UpdateBase
+from starlette.config import Config
 
 from models import User, Base, OAuthAccount
 
-DATABASE_URL = "sqlite+aiosqlite:///./test.db"
+config = Config('.env')
 
-engine = create_async_engine(DATABASE_URL)
-async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
+DATABASE_URL = config('DATABASE_URL', default="sqlite+aiosqlite:///./test.db")
+# Connections for reads; SQLite lets them run alongside the writer in WAL mode.
+# A request's session holds one from its first query until the request ends, which
+# FastAPI runs after the response is sent: handlers that go on to copy an upload or
+# return a file call release_connection first, so slow clients do not drain the pool
+DB_READ_POOL_SIZE = config('DB_READ_POOL_SIZE', cast=int, default=8)
+# How long a write waits for the writer connection before failing, in seconds
+DB_WRITE_TIMEOUT = config('DB_WRITE_TIMEOUT', cast=float, default=30.0)
+
+SQLITE_PRAGMAS = {
+    # Readers do not block the writer and the writer does not block readers
+    "journal_mode": "WAL",
+    # In WAL mode a crash can lose the last commits but never corrupts the database
+    "synchronous": "NORMAL",
+    # Wait for locks held by other processes (workers, sqlite3 shell) instead of failing at once
+    "busy_timeout": config('SQLITE_BUSY_TIMEOUT', cast=int, default=5000),
+    # Page cache per connection, in KiB when negative
+    "cache_size": config('SQLITE_CACHE_SIZE', cast=int, default=-16384),
+    "mmap_size": config('SQLITE_MMAP_SIZE', cast=int, default=256 * 1024 * 1024),
+}
+
+# SQLite has a single writer: all writes share one connection, and sessions wanting
+# to write queue for it in the pool instead of failing with "database is locked"
+engine = create_async_engine(DATABASE_URL, pool_size=1, max_overflow=0, pool_timeout=DB_WRITE_TIMEOUT)
+read_engine = create_async_engine(DATABASE_URL, pool_size=DB_READ_POOL_SIZE, max_overflow=0)
+
+
+def _set_pragmas(dbapi_connection, read_only: bool):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    if read_only:
+        # A write routed to a reader by mistake fails instead of racing the writer
+        cursor.execute("PRAGMA query_only = 1")
+    cursor.close()
+
+
+if engine.dialect.name == "sqlite":
+    event.listen(engine.sync_engine, "connect", lambda connection, record: _set_pragmas(connection, False))
+    event.listen(read_engine.sync_engine, "connect", lambda connection, record: _set_pragmas(connection, True))
+
+
+class RoutingSession(Session):
+    """Sends flushes and INSERT/UPDATE/DELETE statements to the writer and the rest to the read pool.
+
+    Once a transaction has written, it stays on the writer until it ends, so
+    it reads its own uncommitted changes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.writing = False
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.writing or self._flushing or isinstance(clause, UpdateBase):
+            self.writing = True
+            return engine.sync_engine
+        return read_engine.sync_engine
+
+
+@event.listens_for(RoutingSession, "after_transaction_end")
+def _end_writing(session, transaction):
+    if transaction.parent is None:
+        session.writing = False
+
+
+async_session_maker = async_sessionmaker(sync_session_class=RoutingSession, expire_on_commit=False)
+
+
+def add_missing_columns(conn):
+    """Add columns (and their indexes) that were added to the models after their table was created"""
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                ddl = CreateColumn(column).compile(dialect=conn.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {ddl}'))
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
 
 
 async def create_db_and_tables():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(add_missing_columns)
+
+
+async def release_connection(session: AsyncSession):
+    """End the session's transaction so its connection goes back to the pool.
+
+    Loaded objects stay usable (expire_on_commit=False), and the next query
+    starts a new transaction.
+    """
+    await session.commit()
 
 
 async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
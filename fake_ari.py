@@ -0,0 +1,118 @@
+"""Minimal stand-in for the Asterisk REST Interface, for running the dialer offline.
+
+Start it with ``python fake_ari.py`` and point the app at it with
+``ARI_BASE_URL=http://127.0.0.1:8088/ari``. Every originated channel is
+answered after FAKE_ARI_ANSWER_SECONDS, presses one of FAKE_ARI_DTMF_DIGITS
+and is hung up FAKE_ARI_CALL_SECONDS later; the events are pushed to all
+clients connected to ``/ari/events``.
+"""
+import asyncio
+import datetime
+import json
+import random
+from typing import Dict, List
+from uuid import uuid4
+
+import uvicorn
+from fastapi import APIRouter, FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from starlette.config import Config
+
+config = Config('.env')
+
+FAKE_ARI_ANSWER_SECONDS = config('FAKE_ARI_ANSWER_SECONDS', cast=float, default=1.0)
+FAKE_ARI_CALL_SECONDS = config('FAKE_ARI_CALL_SECONDS', cast=float, default=5.0)
+# Share of calls that are not answered (hang up with cause 19 "No answer")
+FAKE_ARI_NO_ANSWER_RATE = config('FAKE_ARI_NO_ANSWER_RATE', cast=float, default=0.0)
+# Digits an answered callee may press; one of them is sent as ChannelDtmfReceived
+FAKE_ARI_DTMF_DIGITS = config('FAKE_ARI_DTMF_DIGITS', default='123')
+
+app = FastAPI()
+ari_router = APIRouter()
+
+channels: Dict[str, dict] = {}
+subscribers: List[WebSocket] = []
+
+
+def timestamp() -> str:
+    return datetime.datetime.now().isoformat()
+
+
+async def emit(event_type: str, channel: dict, **fields):
+    event = {"type": event_type, "timestamp": timestamp(), "application": "autocall", "channel": channel, **fields}
+    message = json.dumps(event)
+    for ws in list(subscribers):
+        try:
+            await ws.send_text(message)
+        except Exception:
+            subscribers.remove(ws)
+
+
+async def destroy(channel_id: str, cause: int, cause_txt: str):
+    channel = channels.pop(channel_id, None)
+    if channel is not None:
+        await emit("ChannelDestroyed", channel, cause=cause, cause_txt=cause_txt)
+
+
+async def run_call(channel_id: str):
+    await asyncio.sleep(FAKE_ARI_ANSWER_SECONDS)
+    channel = channels.get(channel_id)
+    if channel is None:
+        return
+    if random.random() < FAKE_ARI_NO_ANSWER_RATE:
+        await destroy(channel_id, 19, "No answer")
+        return
+    channel["state"] = "Up"
+    await emit("ChannelStateChange", channel)
+    if FAKE_ARI_DTMF_DIGITS:
+        await asyncio.sleep(FAKE_ARI_CALL_SECONDS / 2)
+        await emit("ChannelDtmfReceived", channel, digit=random.choice(FAKE_ARI_DTMF_DIGITS), duration_ms=100)
+        await asyncio.sleep(FAKE_ARI_CALL_SECONDS / 2)
+    else:
+        await asyncio.sleep(FAKE_ARI_CALL_SECONDS)
+    await destroy(channel_id, 16, "Normal Clearing")
+
+
+@ari_router.post("/channels")
+async def originate(request: Request, endpoint: str, channelId: str = None):
+    channel = {
+        "id": channelId or str(uuid4()),
+        "name": f"{endpoint}-{len(channels):08x}",
+        "state": "Down",
+        "caller": {"name": "", "number": ""},
+        "connected": {"name": "", "number": endpoint.split('/')[-1]},
+        "creationtime": timestamp(),
+    }
+    channels[channel["id"]] = channel
+    asyncio.create_task(run_call(channel["id"]))
+    return channel
+
+
+@ari_router.get("/channels")
+async def list_channels():
+    return list(channels.values())
+
+
+@ari_router.delete("/channels/{channel_id}", status_code=204)
+async def hangup(channel_id: str):
+    if channel_id not in channels:
+        raise HTTPException(status_code=404, detail="Channel not found")
+    await destroy(channel_id, 16, "Normal Clearing")
+
+
+@ari_router.websocket("/events")
+async def events(websocket: WebSocket):
+    await websocket.accept()
+    subscribers.append(websocket)
+    try:
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        if websocket in subscribers:
+            subscribers.remove(websocket)
+
+
+app.include_router(ari_router, prefix="/ari")
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host='127.0.0.1', port=8088)
@@ -0,0 +1,75 @@
+import asyncio
+import datetime
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+from uuid import uuid4
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+# Finished jobs kept around so clients can still read their result
+JOBS_KEEP = 1000
+
+
+class Job:
+    def __init__(self, kind: str, user_id: int):
+        self.id = uuid4().hex
+        self.kind = kind
+        self.user_id = user_id
+        self.status = JOB_QUEUED
+        self.progress: Dict[str, Any] = {}
+        self.error: Optional[str] = None
+        self.created_at = datetime.datetime.utcnow()
+        self.finished_at: Optional[datetime.datetime] = None
+
+
+class JobRegistry:
+    """In-process registry of background jobs (imports, transcoding) and their progress"""
+
+    def __init__(self):
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._tasks = set()
+
+    def create(self, kind: str, user_id: int) -> Job:
+        job = Job(kind, user_id)
+        self._jobs[job.id] = job
+        while len(self._jobs) > JOBS_KEEP:
+            oldest = next(iter(self._jobs.values()))
+            if oldest.finished_at is None:
+                break
+            self._jobs.popitem(last=False)
+        return job
+
+    def get(self, job_id: str, user_id: int) -> Optional[Job]:
+        job = self._jobs.get(job_id)
+        if job is None or job.user_id != user_id:
+            return None
+        return job
+
+    def start(self, job: Job, run: Callable[[Job], Awaitable[None]]):
+        task = asyncio.create_task(self._run(job, run))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, job: Job, run: Callable[[Job], Awaitable[None]]):
+        job.status = JOB_RUNNING
+        try:
+            await run(job)
+            job.status = JOB_DONE
+        except Exception as e:
+            print(f"Job {job.kind} {job.id} failed: {e}")
+            job.status = JOB_FAILED
+            job.error = str(e)
+        finally:
+            job.finished_at = datetime.datetime.utcnow()
+
+    async def shutdown(self):
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+jobs = JobRegistry()
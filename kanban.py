@@ -0,0 +1,433 @@
+import asyncio
+import re
+from typing import Any, Dict, FrozenSet, List, Optional, Set, Tuple
+
+from pydantic_core import to_jsonable_python
+from sqlalchemy import and_, column, delete, event, func, or_, select, table, text, true, update
+from starlette.config import Config
+
+from connections import manager
+from db import async_session_maker, engine
+from models import KanbanCard, KanbanChange, KanbanColumn, user_kanban_card_associacion
+from phones import PHONE_DASHES
+from ranks import rank_between, spread_ranks
+
+config = Config('.env')
+
+# Events kept for resuming clients; one that fell further behind gets a full snapshot
+KANBAN_CHANGELOG_SIZE = config('KANBAN_CHANGELOG_SIZE', cast=int, default=1000)
+KANBAN_PAGE_SIZE = 100
+# Operations in one batch message
+KANBAN_BATCH_SIZE = 1000
+# Moves into the same spot lengthen rank keys; past this length the column (or board) is re-ranked
+KANBAN_RANK_MAX_LENGTH = config('KANBAN_RANK_MAX_LENGTH', cast=int, default=12)
+
+# Columns without an owner form the shared board every client sees
+PUBLIC_BOARD = "board:public"
+
+
+def board_topic(user_id: Optional[int]) -> str:
+    """Topic of the board made of the columns owned by ``user_id``"""
+    return PUBLIC_BOARD if user_id is None else f"board:{user_id}"
+
+
+def user_topic(user_id: int) -> str:
+    """Topic of the cards assigned to a user"""
+    return f"user:{user_id}"
+
+
+def allowed_topics(user_id: Optional[int]) -> Set[str]:
+    """Topics a client may subscribe to: the shared board, plus its own board and cards"""
+    if user_id is None:
+        return {PUBLIC_BOARD}
+    return {PUBLIC_BOARD, board_topic(user_id), user_topic(user_id)}
+
+
+def visible_columns(user_id: Optional[int]):
+    """Filter for the columns a client can see"""
+    if user_id is None:
+        return KanbanColumn.user_id.is_(None)
+    return or_(KanbanColumn.user_id.is_(None), KanbanColumn.user_id == user_id)
+
+
+def _assigned_cards(user_id: int):
+    return select(user_kanban_card_associacion.c.kanban_card_id).where(
+        user_kanban_card_associacion.c.user_id == user_id
+    )
+
+
+def visible_cards(user_id: Optional[int]):
+    """Filter for the cards a client can see: those in its visible columns and those assigned to it.
+
+    The same rule as card_visible and card_topics, so a client can load,
+    search and change every card it gets events for.
+    """
+    on_board = KanbanCard.column_id.in_(select(KanbanColumn.id).where(visible_columns(user_id)))
+    if user_id is None:
+        return on_board
+    return or_(on_board, KanbanCard.id.in_(_assigned_cards(user_id)))
+
+
+# Owner cache entry of a column that does not exist
+_NO_COLUMN = object()
+
+
+async def _column_owner(session, column_id: Optional[int]):
+    # A column never changes owner: looked up once per session, i.e. per message or batch
+    owners = session.info.setdefault("kanban_column_owners", {})
+    if column_id not in owners:
+        row = (await session.execute(select(KanbanColumn.user_id).where(KanbanColumn.id == column_id))).first()
+        owners[column_id] = _NO_COLUMN if row is None else row.user_id
+    return owners[column_id]
+
+
+async def column_topics(session, column_id: Optional[int]) -> Set[str]:
+    owner = await _column_owner(session, column_id)
+    return {board_topic(None if owner is _NO_COLUMN else owner)}
+
+
+async def column_visible(session, user_id: Optional[int], column_id: Optional[int]) -> bool:
+    """Whether the column exists and is on a board the client sees, and so may change"""
+    owner = await _column_owner(session, column_id)
+    return owner is not _NO_COLUMN and (owner is None or owner == user_id)
+
+
+async def card_visible(session, user_id: Optional[int], card: KanbanCard) -> bool:
+    """Whether the client sees the card, and so may change it: see visible_cards"""
+    if await column_visible(session, user_id, card.column_id):
+        return True
+    if user_id is None:
+        return False
+    query = _assigned_cards(user_id).where(user_kanban_card_associacion.c.kanban_card_id == card.id)
+    return (await session.execute(query)).first() is not None
+
+
+def forget_column(session, column_id: int):
+    """Mark a column deleted in this session as missing, so later operations of a batch cannot use it"""
+    session.info.setdefault("kanban_column_owners", {})[column_id] = _NO_COLUMN
+
+
+async def card_topics(session, card: KanbanCard) -> Set[str]:
+    """Topics of the sockets that see a card: its column's board and the users it is assigned to"""
+    query = select(user_kanban_card_associacion.c.user_id).where(
+        user_kanban_card_associacion.c.kanban_card_id == card.id
+    )
+    users = (await session.execute(query)).scalars().all()
+    return await column_topics(session, card.column_id) | {user_topic(user_id) for user_id in users}
+
+
+def card_cursor(card: KanbanCard) -> List[Any]:
+    """Position of a card in (column_id, rank, id) order, as sent to clients"""
+    return [card.column_id, card.rank, card.id]
+
+
+def _after_card(cursor: List[Any]):
+    """Filter for the cards after ``cursor`` in (column_id, rank, id) order; cards without a rank come first"""
+    column_id, rank, card_id = cursor
+    if rank is None:
+        within = or_(and_(KanbanCard.rank.is_(None), KanbanCard.id > card_id), KanbanCard.rank.is_not(None))
+    else:
+        within = or_(KanbanCard.rank > rank, and_(KanbanCard.rank == rank, KanbanCard.id > card_id))
+    return or_(KanbanCard.column_id > column_id, and_(KanbanCard.column_id == column_id, within))
+
+
+async def page_cards(
+    session,
+    user_id: Optional[int],
+    column_id: Optional[int] = None,
+    after: Optional[List[Any]] = None,
+    limit: int = KANBAN_PAGE_SIZE,
+) -> List[KanbanCard]:
+    """Visible cards, of one column or all, starting after the card at cursor ``after``"""
+    query = select(KanbanCard).where(visible_cards(user_id))
+    if column_id:
+        query = query.where(KanbanCard.column_id == column_id)
+    if after:
+        query = query.where(_after_card(after))
+    query = query.order_by(KanbanCard.column_id, KanbanCard.rank, KanbanCard.id).limit(limit)
+    result = await session.execute(query)
+    return result.scalars().all()
+
+
+async def log_change(session, topics: Set[str], message: Dict[str, Any]) -> Dict[str, Any]:
+    """Add an event to the log in the session's transaction; returns it with its seq"""
+    message = to_jsonable_python(message)
+    change = KanbanChange(topics=sorted(topics), message=message)
+    session.add(change)
+    await session.flush()
+    await session.execute(delete(KanbanChange).where(KanbanChange.seq <= change.seq - KANBAN_CHANGELOG_SIZE))
+    return {**message, "seq": change.seq}
+
+
+async def publish_change(session, topics: Set[str], message: Dict[str, Any]) -> int:
+    """Log an event under the next seq, commit, then publish it with that seq to the topics"""
+    message = await log_change(session, topics, message)
+    await session.commit()
+    await manager.publish(topics, message)
+    return message["seq"]
+
+
+class KanbanBatch:
+    """Events of the Kanban mutations applied in one transaction.
+
+    commit() logs them and commits them together with the mutations, then
+    publishes one message per set of topics: the event itself, or
+    {"action": "batch", "events": [...]} when there are several.
+    """
+
+    def __init__(self):
+        self.events: Dict[FrozenSet[str], List[Dict[str, Any]]] = {}
+        self._ranks: List[Tuple[str, Optional[int], bool]] = []
+        # Cards loaded up front: the session's identity map holds them only while they are referenced
+        self.cards: List[KanbanCard] = []
+
+    def add(self, topics: Set[str], message: Dict[str, Any]):
+        # Serialized now: a later operation of the batch may change the same row
+        self.events.setdefault(frozenset(topics), []).append(to_jsonable_python(message))
+
+    def check_rank(self, rank: str, column_id: Optional[int] = None, columns: bool = False):
+        self._ranks.append((rank, column_id, columns))
+
+    async def commit(self, session):
+        messages = []
+        for topics, events in self.events.items():
+            message = events[0] if len(events) == 1 else {"action": "batch", "events": events}
+            messages.append((topics, await log_change(session, topics, message)))
+        await session.commit()
+        for topics, message in messages:
+            await manager.publish(topics, message)
+        for rank, column_id, columns in self._ranks:
+            rebalancer.check(rank, column_id, columns)
+
+
+async def last_seq(session) -> int:
+    return await session.scalar(select(func.max(KanbanChange.seq))) or 0
+
+
+async def changes_since(session, seq: int, topics: Set[str]) -> Tuple[int, Optional[List[Dict[str, Any]]]]:
+    """The last seq and the events after ``seq`` on any of the topics, oldest first.
+
+    The events are None if the log no longer holds all of them (truncated, or
+    ``seq`` is not from this database): the client has to reload the board.
+    """
+    query = select(func.min(KanbanChange.seq), func.max(KanbanChange.seq))
+    first, last = (await session.execute(query)).one()
+    last = last or 0
+    if seq > last or (first is not None and seq < first - 1):
+        return last, None
+    query = select(KanbanChange).where(KanbanChange.seq > seq, KanbanChange.seq <= last).order_by(KanbanChange.seq)
+    changes = (await session.execute(query)).scalars().all()
+    return last, [{**change.message, "seq": change.seq} for change in changes if topics.intersection(change.topics)]
+
+
+
+async def rank_after(session, model, after_id, moved_id=None, scope=true()) -> str:
+    """Rank placing a row right after the row ``after_id`` (first if None) among the rows matching ``scope``"""
+    previous = None
+    if after_id is not None:
+        previous = await session.scalar(select(model.rank).where(model.id == after_id, scope))
+        if previous is None:
+            raise ValueError(f"{model.__name__} {after_id} not found")
+    query = select(func.min(model.rank)).where(scope, model.id != moved_id)
+    if previous is not None:
+        query = query.where(model.rank > previous)
+    return rank_between(previous, await session.scalar(query))
+
+
+async def rank_last(session, model, scope=true()) -> str:
+    return rank_between(await session.scalar(select(func.max(model.rank)).where(scope)), None)
+
+
+async def rerank(session, model, order, scope=true()) -> Dict[Any, str]:
+    """Give the rows matching ``scope`` short evenly spaced ranks, keeping their order; returns {id: rank}"""
+    query = select(model.id).where(scope).order_by(model.rank.is_(None), model.rank, *order, model.id)
+    ids = (await session.execute(query)).scalars().all()
+    ranks = dict(zip(ids, spread_ranks(len(ids))))
+    if ranks:
+        await session.execute(update(model), [{"id": row_id, "rank": rank} for row_id, rank in ranks.items()])
+    return ranks
+
+
+async def rerank_cards(session, column_id: Optional[int]) -> Dict[str, str]:
+    return await rerank(session, KanbanCard, [KanbanCard.datetime], KanbanCard.column_id == column_id)
+
+
+async def rerank_columns(session) -> Dict[int, str]:
+    return await rerank(session, KanbanColumn, [KanbanColumn.position])
+
+
+class RankRebalancer:
+    """Re-ranks a column's cards, or the columns, in the background once a key gets too long.
+
+    Clients get one rerank_cards / rerank_columns event with every new rank.
+    """
+
+    def __init__(self):
+        self._pending: Set[Any] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+    def check(self, rank: str, column_id: Optional[int] = None, columns: bool = False):
+        key = "columns" if columns else column_id
+        if len(rank) <= KANBAN_RANK_MAX_LENGTH or key in self._pending:
+            return
+        self._pending.add(key)
+        task = asyncio.create_task(self._run(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key):
+        try:
+            async with async_session_maker() as session:
+                if key == "columns":
+                    ranks = await rerank_columns(session)
+                    owners = (await session.execute(select(KanbanColumn.user_id).distinct())).scalars().all()
+                    topics = {board_topic(owner) for owner in owners}
+                    await publish_change(session, topics, {"action": "rerank_columns", "ranks": ranks})
+                else:
+                    ranks = await rerank_cards(session, key)
+                    topics = await column_topics(session, key)
+                    await publish_change(session, topics, {"action": "rerank_cards", "kanban_column_id": key, "ranks": ranks})
+        except Exception as e:
+            print(f"Kanban rerank failed: {e!r}")
+        finally:
+            self._pending.discard(key)
+
+
+async def migrate_kanban_ranks():
+    """Rank the columns and cards created before ranks existed, in their old order"""
+    async with async_session_maker() as session:
+        if await session.scalar(select(KanbanColumn.id).where(KanbanColumn.rank.is_(None)).limit(1)) is not None:
+            await rerank_columns(session)
+        query = select(KanbanCard.column_id).where(KanbanCard.rank.is_(None)).distinct()
+        for column_id in (await session.execute(query)).scalars().all():
+            await rerank_cards(session, column_id)
+        await session.commit()
+
+
+rebalancer = RankRebalancer()
+
+
+def _migrate_kanban_owners(conn):
+    # Before private boards every column was shared, including the ones that got a user_id
+    # from elsewhere (test data, imports); they become public once, and their owners are kept
+    # in kanban_column_owners_backup, which also marks the migration as done
+    if conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'kanban_column_owners_backup'")).first():
+        return
+    conn.execute(text("CREATE TABLE kanban_column_owners_backup (column_id INTEGER PRIMARY KEY, user_id INTEGER)"))
+    conn.execute(text(
+        "INSERT INTO kanban_column_owners_backup (column_id, user_id)"
+        " SELECT id, user_id FROM kanban_columns WHERE user_id IS NOT NULL"
+    ))
+    conn.execute(text("UPDATE kanban_columns SET user_id = NULL WHERE user_id IS NOT NULL"))
+
+
+async def migrate_kanban_owners():
+    """Put the columns created before private boards on the public board"""
+    async with engine.begin() as conn:
+        await conn.run_sync(_migrate_kanban_owners)
+
+# Full-text index of the cards: contentless FTS5 table kept in sync by triggers.
+# phone is indexed from phone_digits, one digits-only token per number, so that
+# "+7 (999) 12" finds +7‒999‒123‒45‒67 by prefix.
+_kanban_fts = table("kanban_cards_fts", column("rowid"), column("rank"))
+_SEARCH_TOKEN = re.compile(r"\w+")
+_PHONE_QUERY = re.compile(rf"[\d\s()+.{PHONE_DASHES}]+")
+_PHONE_SEPARATOR = re.compile(r"[,;/]")
+_NOT_DIGIT = re.compile(r"\D")
+
+
+def phone_digits(phone: Optional[str]) -> Optional[str]:
+    """The numbers of a phone field ("+7‒701‒260‒00‒02, 8 (747) 901-01-93") as digits only, space-separated"""
+    if not phone:
+        return None
+    numbers = [_NOT_DIGIT.sub("", number) for number in _PHONE_SEPARATOR.split(phone)]
+    return " ".join(number for number in numbers if number) or None
+
+
+@event.listens_for(KanbanCard, "before_insert")
+@event.listens_for(KanbanCard, "before_update")
+def _set_phone_digits(mapper, connection, card: KanbanCard):
+    card.phone_digits = phone_digits(card.phone)
+
+
+def _index_row(row: str) -> str:
+    return f"{row}.search_id, {row}.name, {row}.company, {row}.phone_digits"
+
+
+_KANBAN_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE kanban_cards_fts USING fts5(name, company, phone, content='', tokenize='unicode61 remove_diacritics 2')",
+    f"""CREATE TRIGGER kanban_cards_fts_insert AFTER INSERT ON kanban_cards BEGIN
+        UPDATE kanban_cards SET search_id = (SELECT COALESCE(MAX(search_id), 0) + 1 FROM kanban_cards)
+            WHERE rowid = new.rowid AND search_id IS NULL;
+        INSERT INTO kanban_cards_fts(rowid, name, company, phone)
+            SELECT {_index_row('kanban_cards')} FROM kanban_cards WHERE rowid = new.rowid;
+    END""",
+    f"""CREATE TRIGGER kanban_cards_fts_delete AFTER DELETE ON kanban_cards BEGIN
+        INSERT INTO kanban_cards_fts(kanban_cards_fts, rowid, name, company, phone) VALUES ('delete', {_index_row('old')});
+    END""",
+    f"""CREATE TRIGGER kanban_cards_fts_update AFTER UPDATE OF name, company, phone_digits ON kanban_cards BEGIN
+        INSERT INTO kanban_cards_fts(kanban_cards_fts, rowid, name, company, phone) VALUES ('delete', {_index_row('old')});
+        INSERT INTO kanban_cards_fts(rowid, name, company, phone) VALUES ({_index_row('new')});
+    END""",
+    f"INSERT INTO kanban_cards_fts(rowid, name, company, phone) SELECT {_index_row('kanban_cards')} FROM kanban_cards",
+]
+
+
+def _create_kanban_search(conn):
+    trigger = conn.execute(text("SELECT sql FROM sqlite_master WHERE name = 'kanban_cards_fts_insert'")).scalar()
+    if trigger is not None and "search_id" in trigger:
+        return
+    # First start, or an index built from the phone column with punctuation stripped in SQL
+    # or keyed on rowid: rebuilt
+    for name in ("insert", "delete", "update"):
+        conn.execute(text(f"DROP TRIGGER IF EXISTS kanban_cards_fts_{name}"))
+    conn.execute(text("DROP TABLE IF EXISTS kanban_cards_fts"))
+    rows = conn.execute(text("SELECT rowid, phone FROM kanban_cards WHERE phone IS NOT NULL")).all()
+    if rows:
+        conn.execute(text("UPDATE kanban_cards SET phone_digits = :digits WHERE rowid = :rowid"),
+                     [{"rowid": rowid, "digits": phone_digits(phone)} for rowid, phone in rows])
+    conn.execute(text("UPDATE kanban_cards SET search_id = rowid WHERE search_id IS NULL"))
+    for statement in _KANBAN_SEARCH_DDL:
+        conn.execute(text(statement))
+
+
+async def migrate_kanban_search():
+    """Create the search index, filled from the existing cards, on first start"""
+    async with engine.begin() as conn:
+        await conn.run_sync(_create_kanban_search)
+
+
+def search_query(query: str) -> Optional[str]:
+    """FTS5 query matching every word of ``query`` as a prefix, or a phone number starting with its digits"""
+    tokens = _SEARCH_TOKEN.findall(query)
+    if not tokens:
+        return None
+    match = " AND ".join(f'"{token}"*' for token in tokens)
+    if _PHONE_QUERY.fullmatch(query):
+        phone = f'phone : "{_NOT_DIGIT.sub("", query)}"*'
+        # A formatted number is only looked up as a phone: its short digit groups would match nearly every card
+        return phone if len(tokens) > 1 else f"{match} OR {phone}"
+    return match
+
+
+async def search_cards(
+    session,
+    user_id: Optional[int],
+    query: str,
+    column_id: Optional[int] = None,
+    limit: int = KANBAN_PAGE_SIZE,
+) -> List[KanbanCard]:
+    """Visible cards matching a search query, best matches first"""
+    match = search_query(query)
+    if match is None:
+        return []
+    statement = (
+        select(KanbanCard)
+        .join(_kanban_fts, _kanban_fts.c.rowid == KanbanCard.search_id)
+        .where(text("kanban_cards_fts MATCH :match").bindparams(match=match), visible_cards(user_id))
+    )
+    if column_id:
+        statement = statement.where(KanbanCard.column_id == column_id)
+    statement = statement.order_by(_kanban_fts.c.rank).limit(limit)
+    result = await session.execute(statement)
+    return result.scalars().all()
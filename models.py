@@ -3,7 +3,7 @@ from typing import Dict, List, Optional
 
 from fastapi_users_db_sqlalchemy import SQLAlchemyBaseUserTable, SQLAlchemyBaseOAuthAccountTable
 from pydantic import BaseModel
-from sqlalchemy import Table, Column, DateTime, ForeignKey, Integer, String, Time, JSON, ARRAY
+from sqlalchemy import Table, Boolean, Column, DateTime, Float, ForeignKey, Index, Integer, String, Time, JSON, ARRAY, text
 from pydantic import BaseModel, EmailStr
 from sqlalchemy.orm import DeclarativeBase, Mapped, relationship, declared_attr
 
@@ -56,28 +56,129 @@ class PhoneListModel(Base):
     __tablename__ = "phones"
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String)
-    phones = Column(JSON)
+    # Numbers that can be dialed; ``invalid`` counts the ones kept as stored, see PhoneNumberModel.valid
+    size = Column(Integer, default=0)
+    invalid = Column(Integer, default=0, server_default="0")
     user_id = Column(Integer, ForeignKey('user.id'))
 
 
+class PhoneNumberModel(Base):
+    __tablename__ = "phone_numbers"
+    __table_args__ = (
+        Index('ix_phone_numbers_list_number', 'list_id', 'number', unique=True),
+        Index('ix_phone_numbers_list_id', 'list_id', 'id'),
+        Index('ix_phone_numbers_invalid', 'list_id', sqlite_where=text('valid = 0')),
+    )
+    id = Column(Integer, primary_key=True)
+    list_id = Column(Integer, ForeignKey('phones.id', ondelete='CASCADE'))
+    number = Column(String)
+    # False for numbers of old JSON lists that failed validation: kept as stored, never dialed
+    valid = Column(Boolean, nullable=False, default=True, server_default="1")
+
+
+class CampaignModel(Base):
+    __tablename__ = "campaigns"
+    id = Column(Integer, primary_key=True, index=True)
+    company_id = Column(Integer, ForeignKey('companies.id'), index=True)
+    user_id = Column(Integer, ForeignKey('user.id'))
+    status = Column(String, index=True)
+    sound_file = Column(String)
+    reaction = Column(JSON)
+    # Id of the last phone_numbers row dialed, not a count
+    cursor = Column(Integer, default=0)
+    # Progress is dialed / total: distinct numbers of the list dialed so far; retries are counted apart
+    total = Column(Integer, default=0)
+    dialed = Column(Integer, default=0)
+    retried = Column(Integer, default=0, server_default="0")
+    max_retries = Column(Integer, nullable=True)
+    retry_delay = Column(Integer, nullable=True)
+    retry_backoff = Column(Float, nullable=True)
+    error = Column(String, nullable=True)
+    # Worker dialing the campaign and until when its claim holds, see campaigns.CampaignScheduler
+    owner = Column(String, nullable=True)
+    lease_until = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+
+class CallAttempt(Base):
+    __tablename__ = "call_attempts"
+    __table_args__ = (
+        Index('ix_call_attempts_company_created', 'company_id', 'created_at'),
+        Index('ix_call_attempts_campaign_status', 'campaign_id', 'status'),
+        Index('ix_call_attempts_campaign_reaction', 'campaign_id', 'reaction'),
+    )
+    id = Column(Integer, primary_key=True)
+    company_id = Column(Integer, ForeignKey('companies.id'))
+    campaign_id = Column(Integer, ForeignKey('campaigns.id'))
+    phone = Column(String, index=True)
+    channel_id = Column(String, unique=True)
+    status = Column(String)
+    reaction = Column(String, nullable=True)
+    hangup_cause = Column(Integer, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    answered_at = Column(DateTime, nullable=True)
+    ended_at = Column(DateTime, nullable=True)
+
+
+class CallRetry(Base):
+    __tablename__ = "call_retries"
+    __table_args__ = (
+        Index('ix_call_retries_campaign_phone', 'campaign_id', 'phone', unique=True),
+        Index('ix_call_retries_campaign_due', 'campaign_id', 'next_attempt_at'),
+    )
+    id = Column(Integer, primary_key=True)
+    campaign_id = Column(Integer, ForeignKey('campaigns.id'))
+    phone = Column(String)
+    attempt = Column(Integer)
+    next_attempt_at = Column(DateTime)
+    last_status = Column(String, nullable=True)
+
+
 class SoundFileModel(Base):
     __tablename__ = "soundfiles"
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String)
     file_path = Column(String)
     user_id = Column(Integer, ForeignKey('user.id'))
+    # pending while the upload is transcoded, then ready or failed
+    status = Column(String, default="ready", server_default="ready")
+    # Content hash of the upload in the sound store; NULL for files added before it
+    blob_hash = Column(String, ForeignKey('sound_blobs.hash'), nullable=True, index=True)
+
+
+class SoundBlob(Base):
+    """Uploaded audio stored once per content hash and shared by every SoundFileModel with that hash"""
+    __tablename__ = "sound_blobs"
+    hash = Column(String, primary_key=True)
+    extension = Column(String)
+    refcount = Column(Integer, default=0)
+    status = Column(String)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    # When the current conversion started; a pending blob older than sound_files.SOUND_TRANSCODE_STALE is abandoned
+    pending_since = Column(DateTime, nullable=True)
 
 
 class KanbanCard(Base):
     __tablename__ = 'kanban_cards'
-    
+    __table_args__ = (
+        # Cards of a column in board order, see kanban.page_cards
+        Index('ix_kanban_cards_column_rank', 'column_id', 'rank', 'id'),
+    )
     id = Column(String, primary_key=True, index=True)
     name = Column(String, index=True)
     company = Column(String, index=True)
     phone = Column(String, index=True)
+    # Numbers of phone as digits only, separated by spaces, for the search index; see kanban.phone_digits
+    phone_digits = Column(String, nullable=True)
+    # Key of the card in the search index, set by its insert trigger: the implicit rowid of a table
+    # with a String primary key can change on VACUUM, this column never does
+    search_id = Column(Integer, nullable=True, unique=True, index=True)
     comment = Column(String, nullable=True)
     task = Column(String, nullable=True)
     datetime = Column(DateTime, nullable=True)
+    # Order within the column, see ranks.py
+    rank = Column(String, nullable=True)
 
     column_id = Column(Integer, ForeignKey("kanban_columns.id"))
     column = relationship("KanbanColumn", back_populates="tasks")
@@ -94,6 +195,8 @@ class KanbanColumn(Base):
     title = Column(String, index=True)
     tag_color = Column(String, nullable=True)
     position = Column(Integer, nullable=True)
+    # Order on the board, see ranks.py; replaces position
+    rank = Column(String, nullable=True, index=True)
 
     user_id = Column(Integer, ForeignKey("user.id"))
     user = relationship("User")
@@ -101,6 +204,18 @@ class KanbanColumn(Base):
     tasks = relationship("KanbanCard", back_populates="column")
 
 
+class KanbanChange(Base):
+    """Kanban event log: reconnecting clients replay the events after their last seq"""
+    __tablename__ = 'kanban_changes'
+    # AUTOINCREMENT: seq never goes back, even after the log is truncated
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    seq = Column(Integer, primary_key=True)
+    topics = Column(JSON)
+    message = Column(JSON)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+
 class CalendarEvent(Base):
     __tablename__ = 'calendar_events'
     
@@ -0,0 +1,164 @@
+import asyncio
+import datetime
+import time
+from typing import Dict, Optional
+
+from starlette.config import Config
+
+from models import CompanyModel
+
+config = Config('.env')
+
+# Call starts per second allowed for one company, and how many may go out in a burst
+PACER_CALLS_PER_SECOND = config('PACER_CALLS_PER_SECOND', cast=float, default=10.0)
+PACER_BURST = config('PACER_BURST', cast=int, default=10)
+# How long a started call is assumed to occupy a line when its hangup is not observed
+PACER_SLOT_SECONDS = config('PACER_SLOT_SECONDS', cast=float, default=45.0)
+# Upper bound for a single sleep while waiting for the calling window or quota
+PACER_MAX_WAIT = 60.0
+
+
+class CompanyPacer:
+    """Decides when the next call of a company may start.
+
+    A call needs a free line (``com_limit`` concurrent calls), room in the
+    daily quota (``day_limit``), the current time inside the calling window
+    (``start_time``-``end_time`` on ``days``) and a token from the call-start
+    bucket. ``acquire()`` waits exactly as long as those limits require, so
+    lines are refilled as soon as they free up instead of on a fixed timer.
+    """
+
+    def __init__(self, company_id: int):
+        self.company_id = company_id
+        self.com_limit = 1
+        self.day_limit = None
+        self.start_time = None
+        self.end_time = None
+        self.days = None
+
+        self.active = 0
+        self._day = None
+        self._day_count = 0
+        self._tokens = float(PACER_BURST)
+        self._last_refill = time.monotonic()
+        self._changed = asyncio.Condition()
+
+    def configure(self, company: CompanyModel):
+        self.com_limit = max(company.com_limit or 1, 1)
+        self.day_limit = company.day_limit or None
+        self.start_time = company.start_time
+        self.end_time = company.end_time
+        self.days = set(company.days) if company.days else None
+
+    def _day_allowed(self, day: datetime.date) -> bool:
+        if not self.days:
+            return True
+        # Accept both ISO (Monday=1..Sunday=7) and JS (Sunday=0) weekday numbers
+        weekday = day.isoweekday()
+        return weekday in self.days or weekday % 7 in self.days
+
+    def in_window(self, now: datetime.datetime) -> bool:
+        if not self._day_allowed(now.date()):
+            return False
+        if self.start_time is None or self.end_time is None:
+            return True
+        current = now.time()
+        if self.start_time <= self.end_time:
+            return self.start_time <= current < self.end_time
+        return current >= self.start_time or current < self.end_time
+
+    def seconds_until_window(self, now: datetime.datetime) -> float:
+        if self.in_window(now):
+            return 0.0
+        start_time = self.start_time or datetime.time(0, 0)
+        for offset in range(8):
+            day = now.date() + datetime.timedelta(days=offset)
+            opens = datetime.datetime.combine(day, start_time)
+            if opens > now and self._day_allowed(day):
+                return (opens - now).total_seconds()
+        return PACER_MAX_WAIT
+
+    def _roll_day(self, today: datetime.date):
+        if self._day != today:
+            self._day = today
+            self._day_count = 0
+
+    def seed_day_count(self, count: int):
+        """Account for calls already placed today (e.g. before a restart)"""
+        self._roll_day(datetime.date.today())
+        self._day_count = max(self._day_count, count)
+
+    def quota_left(self, today: datetime.date) -> Optional[int]:
+        self._roll_day(today)
+        if self.day_limit is None:
+            return None
+        return self.day_limit - self._day_count
+
+    def _take_token(self) -> float:
+        """Take a call-start token; return how long to wait if there is none"""
+        now = time.monotonic()
+        self._tokens = min(float(PACER_BURST), self._tokens + (now - self._last_refill) * PACER_CALLS_PER_SECOND)
+        self._last_refill = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / PACER_CALLS_PER_SECOND
+
+    async def _wait(self, seconds: float):
+        try:
+            async with self._changed:
+                await asyncio.wait_for(self._changed.wait(), timeout=min(seconds, PACER_MAX_WAIT))
+        except asyncio.TimeoutError:
+            pass
+
+    async def acquire(self):
+        """Wait until one more call of this company may start and reserve a line for it"""
+        while True:
+            now = datetime.datetime.now()
+            wait = self.seconds_until_window(now)
+            if wait:
+                await self._wait(wait)
+                continue
+
+            quota = self.quota_left(now.date())
+            if quota is not None and quota <= 0:
+                tomorrow = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time(0, 0))
+                await self._wait((tomorrow - now).total_seconds())
+                continue
+
+            if self.active >= self.com_limit:
+                async with self._changed:
+                    await self._changed.wait_for(lambda: self.active < self.com_limit)
+                continue
+
+            wait = self._take_token()
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+
+            self.active += 1
+            self._day_count += 1
+            return
+
+    async def release(self):
+        """Free the line reserved by acquire()"""
+        async with self._changed:
+            self.active = max(self.active - 1, 0)
+            self._changed.notify_all()
+
+
+class Pacers:
+    """Process-wide registry so campaigns of one company share its limits"""
+
+    def __init__(self):
+        self._pacers: Dict[int, CompanyPacer] = {}
+
+    def get(self, company: CompanyModel) -> CompanyPacer:
+        pacer = self._pacers.get(company.id)
+        if pacer is None:
+            pacer = self._pacers[company.id] = CompanyPacer(company.id)
+        pacer.configure(company)
+        return pacer
+
+
+pacers = Pacers()
@@ -0,0 +1,159 @@
+import asyncio
+import csv
+import os
+from typing import Iterator, List, Optional, Tuple
+
+from sqlalchemy.dialects.sqlite import insert
+
+from db import async_session_maker
+from jobs import Job
+from models import PhoneListModel, PhoneNumberModel
+from phone_lists import refresh_size
+from phones import normalize_phones
+
+try:
+    import openpyxl
+except ImportError:  # XLSX import is optional
+    openpyxl = None
+
+IMPORT_CHUNK_ROWS = 20000
+IMPORT_UPLOAD_CHUNK = 1024 * 1024
+
+# Header names of the column that holds the phone number
+PHONE_COLUMN_NAMES = {"phone", "phones", "number", "phone_number", "tel", "телефон", "номер"}
+
+IMPORT_FORMATS = (".csv", ".txt", ".xlsx")
+
+# Rejected rows reported back in the job progress
+IMPORT_INVALID_SAMPLES = 20
+
+
+def import_format(filename: str) -> Optional[str]:
+    extension = os.path.splitext(filename or "")[1].lower()
+    if extension not in IMPORT_FORMATS:
+        return None
+    if extension == ".xlsx" and openpyxl is None:
+        return None
+    return extension
+
+
+def _phone_column(header: List) -> Optional[int]:
+    for index, cell in enumerate(header):
+        if str(cell or "").strip().lower() in PHONE_COLUMN_NAMES:
+            return index
+    return None
+
+
+def _chunks(rows: Iterator[List], column: int, progress=None) -> Iterator[List[str]]:
+    chunk = []
+    for row in rows:
+        if len(row) > column and row[column] is not None:
+            chunk.append(str(row[column]))
+        else:
+            chunk.append("")
+        if len(chunk) >= IMPORT_CHUNK_ROWS:
+            if progress:
+                progress()
+            yield chunk
+            chunk = []
+    if chunk:
+        if progress:
+            progress()
+        yield chunk
+
+
+def read_text_chunks(path: str, job: Job) -> Iterator[List[str]]:
+    """Read the phone column of a CSV/TXT file in chunks of IMPORT_CHUNK_ROWS rows"""
+    with open(path, newline="", encoding="utf-8-sig", errors="replace") as f:
+        sample = f.read(4096)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        rows = csv.reader(f, dialect)
+        first = next(rows, None)
+        if first is None:
+            return
+        column = _phone_column(first)
+        if column is None:
+            column = 0
+            rows = _prepend(first, rows)
+
+        def progress():
+            job.progress["bytes_read"] = f.buffer.tell()
+
+        yield from _chunks(rows, column, progress)
+
+
+def read_xlsx_chunks(path: str, job: Job) -> Iterator[List[str]]:
+    """Read the phone column of the first sheet of an XLSX workbook in chunks"""
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        first = next(rows, None)
+        if first is None:
+            return
+        column = _phone_column(list(first))
+        if column is None:
+            column = 0
+            rows = _prepend(first, rows)
+        yield from _chunks((list(row) for row in rows), column)
+    finally:
+        workbook.close()
+
+
+def _prepend(first, rows):
+    yield first
+    yield from rows
+
+
+def _prepare(chunk: List[str]) -> Tuple[List[str], List[str]]:
+    """Normalize a chunk; return its distinct valid numbers and the non-empty rows rejected as invalid"""
+    numbers = normalize_phones(chunk)
+    valid = list(dict.fromkeys(number for number in numbers if number is not None))
+    invalid = [raw for raw, number in zip(chunk, numbers) if number is None and raw.strip()]
+    return valid, invalid
+
+
+async def import_phone_file(job: Job, list_id: int, path: str, extension: str):
+    """Stream numbers from an uploaded file into a phone list.
+
+    Parsing and normalization of each chunk run in a worker thread. Each
+    chunk is deduplicated in memory and written with one executemany INSERT
+    that skips numbers already in the list through the (list_id, number)
+    unique index, so duplicates across chunks cost no memory: only one chunk
+    is held at a time whatever the file size.
+    """
+    reader = read_xlsx_chunks if extension == ".xlsx" else read_text_chunks
+    chunks = reader(path, job)
+    job.progress.update(rows=0, invalid=0, invalid_samples=[], bytes_read=0, bytes_total=os.path.getsize(path))
+    query = insert(PhoneNumberModel).on_conflict_do_nothing(
+        index_elements=[PhoneNumberModel.list_id, PhoneNumberModel.number]
+    )
+    try:
+        async with async_session_maker() as session:
+            size_before = (await session.get(PhoneListModel, list_id)).size or 0
+
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                break
+            numbers, invalid = await asyncio.to_thread(_prepare, chunk)
+            job.progress["rows"] += len(chunk)
+            job.progress["invalid"] += len(invalid)
+            samples = job.progress["invalid_samples"]
+            samples.extend(invalid[:IMPORT_INVALID_SAMPLES - len(samples)])
+            if numbers:
+                async with async_session_maker() as session:
+                    await session.execute(query, [{"list_id": list_id, "number": number} for number in numbers])
+                    await session.commit()
+
+        async with async_session_maker() as session:
+            await refresh_size(session, list_id)
+            await session.commit()
+            size_after = (await session.get(PhoneListModel, list_id)).size or 0
+        job.progress["inserted"] = size_after - size_before
+    finally:
+        chunks.close()
+        os.remove(path)
@@ -0,0 +1,220 @@
+import json
+from typing import AsyncIterator, Iterable, List, Tuple
+
+from sqlalchemy import delete, func, inspect, select, text, update
+from sqlalchemy.dialects.sqlite import insert
+
+from db import async_session_maker, engine
+from models import PhoneListModel, PhoneNumberModel
+from phones import normalize_phones
+
+PHONE_PAGE_SIZE = 1000
+
+
+def split_numbers(numbers: Iterable) -> Tuple[List[str], List[str]]:
+    """Normalize numbers; return the distinct valid ones in order and the raw invalid ones"""
+    raws = [str(raw) for raw in numbers]
+    valid = []
+    invalid = []
+    for raw, number in zip(raws, normalize_phones(raws)):
+        if number is None:
+            invalid.append(raw)
+        else:
+            valid.append(number)
+    return list(dict.fromkeys(valid)), invalid
+
+
+def normalize_numbers(numbers: Iterable) -> List[str]:
+    """Normalize numbers, dropping invalid ones and duplicates but keeping order"""
+    return split_numbers(numbers)[0]
+
+
+async def add_numbers(session, list_id: int, numbers: List[str]):
+    """Insert normalized numbers into a list; numbers already in it are skipped by the unique index"""
+    if numbers:
+        query = insert(PhoneNumberModel).on_conflict_do_nothing(
+            index_elements=[PhoneNumberModel.list_id, PhoneNumberModel.number]
+        )
+        await session.execute(query, [{"list_id": list_id, "number": number} for number in numbers])
+    await refresh_size(session, list_id)
+
+
+async def remove_numbers(session, list_id: int, numbers: List[str]):
+    """Delete numbers from a list; ``numbers`` may also hold the raw values of invalid rows"""
+    if numbers:
+        query = delete(PhoneNumberModel).where(
+            PhoneNumberModel.list_id == list_id,
+            PhoneNumberModel.number.in_(numbers),
+        )
+        await session.execute(query)
+    await refresh_size(session, list_id)
+
+
+async def clear_numbers(session, list_id: int):
+    await session.execute(delete(PhoneNumberModel).where(PhoneNumberModel.list_id == list_id))
+    await refresh_size(session, list_id)
+
+
+def _count_numbers(list_id, valid: bool):
+    return (
+        select(func.count()).select_from(PhoneNumberModel)
+        .where(PhoneNumberModel.list_id == list_id, PhoneNumberModel.valid == valid)
+        .scalar_subquery()
+    )
+
+
+async def refresh_size(session, list_id: int):
+    """Recount a list: ``size`` is the numbers that can be dialed, ``invalid`` the ones kept as stored"""
+    query = update(PhoneListModel).where(PhoneListModel.id == list_id).values(
+        size=_count_numbers(list_id, True), invalid=_count_numbers(list_id, False)
+    )
+    await session.execute(query)
+
+
+async def page_numbers(session, list_id: int, after: int = 0, limit: int = PHONE_PAGE_SIZE) -> List[PhoneNumberModel]:
+    """Numbers of a list in insertion order, starting after the number with id ``after``"""
+    query = (
+        select(PhoneNumberModel)
+        .where(PhoneNumberModel.list_id == list_id, PhoneNumberModel.id > after)
+        .order_by(PhoneNumberModel.id)
+        .limit(limit)
+    )
+    result = await session.execute(query)
+    return result.scalars().all()
+
+
+async def iter_numbers(list_id: int, after: int = 0) -> AsyncIterator[Tuple[int, str]]:
+    """Stream (id, number) pairs of the valid numbers of a list page by page, each page in its own short session"""
+    while True:
+        query = (
+            select(PhoneNumberModel.id, PhoneNumberModel.number)
+            .where(PhoneNumberModel.list_id == list_id, PhoneNumberModel.valid, PhoneNumberModel.id > after)
+            .order_by(PhoneNumberModel.id)
+            .limit(PHONE_PAGE_SIZE)
+        )
+        async with async_session_maker() as session:
+            rows = (await session.execute(query)).all()
+        for row in rows:
+            yield row.id, row.number
+        if len(rows) < PHONE_PAGE_SIZE:
+            return
+        after = rows[-1].id
+
+
+def _legacy_numbers(values) -> Tuple[List[str], List[str]]:
+    """Numbers of an old JSON list: the distinct valid ones, normalized, and the distinct
+    non-blank values failing validation, as stored
+    """
+    values = list(values or [])
+    raws = ["" if value is None else str(value).strip() for value in values]
+    numbers = []
+    invalid = []
+    for value, raw, number in zip(values, raws, normalize_phones(raws)):
+        if number is not None and isinstance(value, (str, int)):
+            numbers.append(number)
+        elif raw:
+            invalid.append(raw)
+    return list(dict.fromkeys(numbers)), list(dict.fromkeys(invalid))
+
+
+def _insert_numbers(conn, list_id: int, numbers: List[str], valid: bool = True):
+    if numbers:
+        query = insert(PhoneNumberModel).on_conflict_do_nothing(
+            index_elements=[PhoneNumberModel.list_id, PhoneNumberModel.number]
+        )
+        conn.execute(query, [{"list_id": list_id, "number": number, "valid": valid} for number in numbers])
+
+
+def _refresh_size(conn, list_id: int):
+    conn.execute(text(
+        "UPDATE phones SET size = (SELECT count(*) FROM phone_numbers WHERE list_id = :id AND valid),"
+        " invalid = (SELECT count(*) FROM phone_numbers WHERE list_id = :id AND NOT valid) WHERE id = :id"
+    ), {"id": list_id})
+
+
+def _migrate_json_phone_lists(conn):
+    """Move numbers from the old ``phones.phones`` JSON column into ``phone_numbers``.
+
+    Numbers passing validation are moved normalized. Values failing it are
+    moved as stored, with ``valid`` false: the list counts them in
+    ``invalid``, the API shows them and the dialer skips them. They become
+    dialable once the PHONE_* settings accept them (see
+    ``_revalidate_numbers``) or are deleted by the list owner. Only blank
+    values (nulls, empty strings) are left out.
+
+    Each list is first copied to ``phones_json_backup``, which also marks it
+    as migrated. To undo, copy ``phones_json_backup.phones`` back into
+    ``phones.phones`` and delete the list's rows from ``phone_numbers``.
+    """
+    columns = {column["name"] for column in inspect(conn).get_columns("phones")}
+    if "phones" not in columns:
+        return
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS phones_json_backup"
+        " (list_id INTEGER PRIMARY KEY, phones JSON, created_at DATETIME DEFAULT CURRENT_TIMESTAMP)"
+    ))
+    rows = conn.execute(text(
+        "SELECT id, phones FROM phones WHERE phones IS NOT NULL"
+        " AND id NOT IN (SELECT list_id FROM phones_json_backup)"
+    )).all()
+    for list_id, phones in rows:
+        conn.execute(text("INSERT INTO phones_json_backup (list_id, phones) VALUES (:id, :phones)"),
+                     {"id": list_id, "phones": phones})
+        values = json.loads(phones) if isinstance(phones, str) else phones
+        numbers, invalid = _legacy_numbers(values)
+        # Valid numbers first, so that they keep their order and come before the invalid ones
+        _insert_numbers(conn, list_id, numbers)
+        _insert_numbers(conn, list_id, invalid, valid=False)
+        _refresh_size(conn, list_id)
+        if invalid:
+            print(f"Phone list {list_id}: {len(invalid)} values failed validation and were kept as invalid"
+                  f" numbers, which are not dialed: {invalid[:10]}")
+        conn.execute(text("UPDATE phones SET phones = NULL WHERE id = :id"), {"id": list_id})
+        # Unfinished campaigns kept their position as an index into the JSON list;
+        # it becomes the id of the last valid number dialed
+        campaigns = conn.execute(text(
+            "SELECT id, cursor FROM campaigns WHERE cursor > 0 AND status IN ('queued', 'running', 'paused', 'failed')"
+            " AND company_id IN (SELECT id FROM companies WHERE phones_id = :list_id)"
+        ), {"list_id": list_id}).all()
+        for campaign_id, position in campaigns:
+            dialed = len(_legacy_numbers((values or [])[:position])[0])
+            cursor = conn.execute(text(
+                "SELECT id FROM phone_numbers WHERE list_id = :list_id AND valid ORDER BY id LIMIT 1 OFFSET :offset"
+            ), {"list_id": list_id, "offset": dialed - 1}).scalar() if dialed else 0
+            conn.execute(text("UPDATE campaigns SET cursor = :cursor WHERE id = :id"),
+                         {"cursor": cursor or 0, "id": campaign_id})
+
+
+def _revalidate_numbers(conn):
+    """Validate the invalid numbers again with the current PHONE_* settings.
+
+    This is the operator's way to recover numbers a migration could not
+    validate: adjust the settings (e.g. PHONE_MIN_LENGTH) and restart.
+    Numbers now passing are normalized and become dialable; those whose
+    normalized form is already in the list are dropped as duplicates.
+    """
+    rows = conn.execute(text("SELECT id, list_id, number FROM phone_numbers WHERE NOT valid")).all()
+    numbers = normalize_phones([row.number for row in rows])
+    lists = set()
+    for row, number in zip(rows, numbers):
+        if number is None:
+            continue
+        lists.add(row.list_id)
+        duplicate = conn.execute(text(
+            "SELECT 1 FROM phone_numbers WHERE list_id = :list_id AND number = :number"
+        ), {"list_id": row.list_id, "number": number}).first()
+        if duplicate:
+            conn.execute(text("DELETE FROM phone_numbers WHERE id = :id"), {"id": row.id})
+        else:
+            conn.execute(text("UPDATE phone_numbers SET number = :number, valid = 1 WHERE id = :id"),
+                         {"number": number, "id": row.id})
+    for list_id in lists:
+        _refresh_size(conn, list_id)
+    if lists:
+        print(f"Phone lists {sorted(lists)}: numbers that failed validation before now pass it and can be dialed")
+
+
+async def migrate_phone_lists():
+    async with engine.begin() as conn:
+        await conn.run_sync(_migrate_json_phone_lists)
+        await conn.run_sync(_revalidate_numbers)
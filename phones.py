@@ -0,0 +1,80 @@
+import re
+from typing import List, Optional
+
+from starlette.config import Config
+
+config = Config('.env')
+
+# Numbers written without a country code are completed with these rules
+PHONE_DEFAULT_COUNTRY_CODE = config('PHONE_DEFAULT_COUNTRY_CODE', default='7')
+PHONE_TRUNK_PREFIX = config('PHONE_TRUNK_PREFIX', default='8')
+PHONE_NATIONAL_LENGTH = config('PHONE_NATIONAL_LENGTH', cast=int, default=10)
+# Bounds on the digit count (country code included) of numbers in other countries
+PHONE_MIN_LENGTH = config('PHONE_MIN_LENGTH', cast=int, default=8)
+PHONE_MAX_LENGTH = 15  # E.164
+# Channel the dialer calls a normalized number on: {number} is the E.164 form (+79991234567),
+# {digits} the same without '+' (79991234567), {national} the trunk-prefixed national form
+# for numbers of the default country (89991234567) and {digits} for the others
+PHONE_DIAL_FORMAT = config('PHONE_DIAL_FORMAT', default='PJSIP/{digits}')
+# Hyphen-minus, the Unicode hyphens and dashes (U+2010-U+2015) and the minus sign
+PHONE_DASHES = '\\-\u2010-\u2015\u2212'
+
+
+def _compile_rules(country_code: str, trunk_prefix: str, national_length: int, min_length: int):
+    """Build the (pattern, replacement) rules applied in order to a batch of lines.
+
+    Each rule works on whole lines of the batch in one regex pass. Lines with
+    anything but digits, ``+``, spaces, dashes, dots and brackets are blanked:
+    letters, ``#``, ``,`` and the like mark an extension (``доб. 12``) whose
+    digits must not be glued onto the number. Then separators are dropped,
+    ``00`` becomes ``+``, trunk-prefixed and bare national numbers get the
+    default country code, any other bare number is taken to start with its
+    own country code. The last rule blanks lines that fail the length check
+    for their country.
+    """
+    rules = [
+        (re.compile(rf'(?m)^.*[^\d\s+().{PHONE_DASHES}].*$'), ''),
+        (re.compile(r'[^\d\n+]'), ''),
+        (re.compile(r'(?<=.)\+'), ''),
+        (re.compile(r'(?m)^00'), '+'),
+    ]
+    valid = rf'\+[1-9]\d{{{min_length - 1},{PHONE_MAX_LENGTH - 1}}}'
+    if country_code:
+        if trunk_prefix:
+            rules.append((re.compile(rf'(?m)^{trunk_prefix}(\d{{{national_length}}})$'), rf'+{country_code}\1'))
+        rules.append((re.compile(rf'(?m)^(\d{{{national_length}}})$'), rf'+{country_code}\1'))
+        valid = rf'\+{country_code}\d{{{national_length}}}|(?!\+{country_code}){valid}'
+    rules.append((re.compile(r'(?m)^(?=\d)'), '+'))
+    rules.append((re.compile(rf'(?m)^(?!(?:{valid})$).*$'), ''))
+    return rules
+
+
+_RULES = _compile_rules(PHONE_DEFAULT_COUNTRY_CODE, PHONE_TRUNK_PREFIX, PHONE_NATIONAL_LENGTH, PHONE_MIN_LENGTH)
+
+
+def normalize_phones(raws: List[str]) -> List[Optional[str]]:
+    """Bring a batch of numbers to E.164 form (``+`` followed by digits); None for invalid ones.
+
+    The batch is joined into one string and every rule runs over it in a
+    single regex pass, which is much cheaper than handling numbers one by one.
+    Numbers are stored in this form, so the dialer uses them as is.
+    """
+    # A cell with line breaks holds several numbers; ',' makes the first rule reject it
+    text = '\n'.join(str(raw).replace('\r', ',').replace('\n', ',') for raw in raws)
+    for pattern, replacement in _RULES:
+        text = pattern.sub(replacement, text)
+    return [number or None for number in text.split('\n')]
+
+
+def normalize_phone(raw) -> Optional[str]:
+    return normalize_phones([raw])[0]
+
+
+def dial_endpoint(number: str, dial_format: str = PHONE_DIAL_FORMAT) -> str:
+    """Channel to originate a call to a number normalized by normalize_phones on"""
+    digits = number.lstrip('+')
+    national = digits
+    prefix = PHONE_DEFAULT_COUNTRY_CODE
+    if prefix and digits.startswith(prefix) and len(digits) == len(prefix) + PHONE_NATIONAL_LENGTH:
+        national = PHONE_TRUNK_PREFIX + digits[len(prefix):]
+    return dial_format.format(number=number, digits=digits, national=national)
@@ -0,0 +1,104 @@
+import asyncio
+from typing import Awaitable, Callable, Iterable, Optional
+from uuid import uuid4
+
+from starlette.config import Config
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # only needed for KANBAN_BROKER_URL=redis://...
+    aioredis = None
+
+config = Config('.env')
+
+# Empty: events stay in this process. redis://host:port/db: events are shared by every worker using it
+KANBAN_BROKER_URL = config('KANBAN_BROKER_URL', default='')
+KANBAN_BROKER_CHANNEL = config('KANBAN_BROKER_CHANNEL', default='kanban')
+BROKER_RECONNECT_DELAY = 1.0
+BROKER_RECONNECT_MAX_DELAY = 30.0
+
+# Called with the topics and the encoded frame of an event published by another worker
+Deliver = Callable[[Iterable[str], str], Awaitable[None]]
+
+
+class LocalBroker:
+    """Single-process backend: the manager already delivers to its own clients, nothing to forward"""
+
+    async def start(self, deliver: Deliver):
+        pass
+
+    async def publish(self, topics: Iterable[str], frame: str):
+        pass
+
+    async def stop(self):
+        pass
+
+
+class RedisBroker:
+    """Forwards events between workers over one Redis pub/sub channel.
+
+    Each message is ``<origin> <topic,topic,...>\\n<frame>``: the frame is
+    passed through as is, and a worker skips the messages it published
+    itself since it has delivered those locally. ``client`` can be any
+    object with the redis.asyncio ``publish``/``pubsub`` interface.
+    """
+
+    def __init__(self, url: str = KANBAN_BROKER_URL, channel: str = KANBAN_BROKER_CHANNEL, client=None):
+        if client is None:
+            if aioredis is None:
+                raise RuntimeError("KANBAN_BROKER_URL needs the redis package")
+            client = aioredis.from_url(url)
+        self.client = client
+        self.channel = channel
+        self.origin = uuid4().hex
+        self._deliver: Optional[Deliver] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, deliver: Deliver):
+        self._deliver = deliver
+        self._task = asyncio.create_task(self._run())
+
+    async def publish(self, topics: Iterable[str], frame: str):
+        try:
+            await self.client.publish(self.channel, f"{self.origin} {','.join(topics)}\n{frame}")
+        except Exception as e:
+            print(f"Kanban broker publish failed: {e}")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        delay = BROKER_RECONNECT_DELAY
+        while True:
+            pubsub = self.client.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                delay = BROKER_RECONNECT_DELAY
+                async for message in pubsub.listen():
+                    if message.get("type") == "message":
+                        await self._handle(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Kanban broker connection lost: {e}")
+            finally:
+                await pubsub.aclose()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, BROKER_RECONNECT_MAX_DELAY)
+
+    async def _handle(self, data):
+        if isinstance(data, bytes):
+            data = data.decode()
+        header, _, frame = data.partition("\n")
+        origin, _, topics = header.partition(" ")
+        if origin != self.origin:
+            await self._deliver(topics.split(","), frame)
+
+
+def create_broker(url: str = KANBAN_BROKER_URL):
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBroker(url)
+    return LocalBroker()
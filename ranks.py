@@ -0,0 +1,85 @@
+from typing import List, Optional
+
+# Rank keys order rows by plain string comparison (SQLite BINARY collation).
+# A key is a base-36 fraction: "i" is 0.5, "0i" is 0.5/36, and so on. Keys never
+# end in "0", so there is always another key between any two of them.
+RANK_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+RANK_BASE = len(RANK_DIGITS)
+
+
+def _digit(key: Optional[str], i: int) -> int:
+    return RANK_DIGITS.index(key[i]) if key is not None and i < len(key) else 0
+
+
+def _to_key(value: int, width: int) -> str:
+    digits = []
+    for _ in range(width):
+        value, digit = divmod(value, RANK_BASE)
+        digits.append(RANK_DIGITS[digit])
+    return "".join(reversed(digits)).rstrip("0")
+
+
+def _to_int(key: str) -> int:
+    value = 0
+    for char in key:
+        value = value * RANK_BASE + RANK_DIGITS.index(char)
+    return value
+
+
+def _midpoint(before: Optional[str], after: Optional[str]) -> str:
+    if before is not None and after is not None:
+        # Keys compare like their values padded with "0" to the same width
+        width = max(len(before), len(after))
+        lo, hi = _to_int(before.ljust(width, "0")), _to_int(after.ljust(width, "0"))
+        if hi - lo > 1:
+            return _to_key((lo + hi) // 2, width)
+    key = []
+    bounded = after is not None
+    i = 0
+    while True:
+        lo = _digit(before, i)
+        hi = _digit(after, i) if bounded else RANK_BASE
+        if hi - lo > 1:
+            key.append(RANK_DIGITS[(lo + hi) // 2])
+            return "".join(key)
+        key.append(RANK_DIGITS[lo])
+        # Past the first digit where the bounds differ the upper bound no longer constrains the key
+        bounded = bounded and hi == lo
+        i += 1
+
+
+def rank_between(before: Optional[str] = None, after: Optional[str] = None) -> str:
+    """A key sorting after ``before`` and before ``after``; None is the start or the end of the list.
+
+    Appending and prepending step the last digit of the edge key, and add a
+    digit once it runs out: keys grow by one character every 18 or so rows
+    added at the same end. Inserting between two rows takes their midpoint,
+    which is one digit longer only when no key of their width lies between
+    them. Keys only stay short because
+    kanban.RankRebalancer respreads a list whose keys get too long.
+    """
+    if before is not None and after is not None and before >= after:
+        raise ValueError(f"Rank {before!r} is not before {after!r}")
+    if before is not None and after is None:
+        value = _to_int(before) + 1
+        if value < RANK_BASE ** len(before):
+            return _to_key(value, len(before))
+    elif before is None and after is not None:
+        value = _to_int(after) - 1
+        if value > 0:
+            return _to_key(value, len(after))
+    return _midpoint(before, after)
+
+
+def spread_ranks(count: int) -> List[str]:
+    """``count`` ascending keys evenly spaced over the middle half of the key space.
+
+    Leaves room at both ends for appends and prepends, and a whole digit
+    between neighbours for moves.
+    """
+    width = 1
+    while RANK_BASE ** width // 2 // max(count, 1) < RANK_BASE:
+        width += 1
+    space = RANK_BASE ** width
+    step = space // 2 // max(count, 1)
+    return [_to_key(space // 4 + i * step, width) for i in range(count)]
@@ -0,0 +1,163 @@
+import asyncio
+import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import bindparam, delete, exists, select, update
+from sqlalchemy.dialects.sqlite import insert
+from starlette.config import Config
+
+from call_log import CALL_BUSY, CALL_FAILED, CALL_NO_ANSWER
+from db import async_session_maker
+from models import CallRetry, CampaignModel
+
+config = Config('.env')
+
+DEFAULT_MAX_RETRIES = 2
+DEFAULT_RETRY_DELAY = 60
+DEFAULT_RETRY_BACKOFF = 2.0
+
+RETRY_STATUSES = (CALL_BUSY, CALL_NO_ANSWER, CALL_FAILED)
+RETRY_CLAIM_LIMIT = 100
+# How long claimed retries stay hidden from claim_due while they are dialed, in seconds;
+# retries of a worker that died before originating them become due again after that
+RETRY_CLAIM_LEASE = config('RETRY_CLAIM_LEASE', cast=float, default=300.0)
+RETRY_FLUSH_INTERVAL = config('RETRY_FLUSH_INTERVAL', cast=float, default=1.0)
+
+
+def retry_delay(campaign: CampaignModel, attempt: int) -> float:
+    """Seconds to wait before retry number ``attempt`` (1-based)"""
+    delay = campaign.retry_delay if campaign.retry_delay is not None else DEFAULT_RETRY_DELAY
+    backoff = campaign.retry_backoff if campaign.retry_backoff is not None else DEFAULT_RETRY_BACKOFF
+    return delay * backoff ** (attempt - 1)
+
+
+class RetryQueue:
+    """Durable per-campaign queue of numbers to dial again.
+
+    Rows live in ``call_retries`` keyed by (campaign_id, phone) and are
+    ordered by ``next_attempt_at``. Scheduled retries are buffered and
+    upserted in bulk on ``flush()``, every RETRY_FLUSH_INTERVAL seconds,
+    and kept for the next flush if that fails.
+
+    The campaign worker claims due rows in batches and dials them ahead of
+    fresh numbers. Claiming only pushes ``next_attempt_at`` RETRY_CLAIM_LEASE
+    seconds ahead; a row is deleted once its call has been handed to
+    Asterisk (``done()``), so retries claimed by a worker that crashed are
+    dialed after the lease.
+    """
+
+    def __init__(self):
+        self._pending: Dict[Tuple[int, str], dict] = {}
+        # (row id, attempt) of claimed retries whose call was originated
+        self._done: Set[Tuple[int, int]] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def schedule(self, campaign: CampaignModel, phone: str, attempt: int, status: Optional[str] = None) -> bool:
+        """Queue retry number ``attempt``; return False once the campaign's max retries is reached"""
+        max_retries = campaign.max_retries if campaign.max_retries is not None else DEFAULT_MAX_RETRIES
+        if attempt > max_retries:
+            return False
+        self._pending[(campaign.id, phone)] = {
+            "campaign_id": campaign.id,
+            "phone": phone,
+            "attempt": attempt,
+            "next_attempt_at": datetime.datetime.utcnow() + datetime.timedelta(seconds=retry_delay(campaign, attempt)),
+            "last_status": status,
+        }
+        return True
+
+    def restore(self, campaign_id: int, retries: List[Tuple[str, int, int]]):
+        """Put claimed but not yet dialed retries back, due immediately"""
+        now = datetime.datetime.utcnow()
+        for phone, attempt, _ in retries:
+            self._pending[(campaign_id, phone)] = {
+                "campaign_id": campaign_id,
+                "phone": phone,
+                "attempt": attempt,
+                "next_attempt_at": now,
+                "last_status": None,
+            }
+
+    def done(self, retry_id: int, attempt: int):
+        """Drop a claimed retry from the queue on the next flush, now that its call is originated"""
+        self._done.add((retry_id, attempt))
+
+    async def flush(self):
+        if not self._pending and not self._done:
+            return
+        pending, self._pending = self._pending, {}
+        done, self._done = self._done, set()
+        query = insert(CallRetry)
+        query = query.on_conflict_do_update(
+            index_elements=[CallRetry.campaign_id, CallRetry.phone],
+            set_={
+                "attempt": query.excluded.attempt,
+                "next_attempt_at": query.excluded.next_attempt_at,
+                "last_status": query.excluded.last_status,
+            },
+        )
+        # A retry scheduled again since it was claimed has a higher attempt and is kept
+        table = CallRetry.__table__
+        remove = delete(table).where(table.c.id == bindparam("b_id"), table.c.attempt == bindparam("b_attempt"))
+        try:
+            async with async_session_maker() as session:
+                if pending:
+                    await session.execute(query, list(pending.values()))
+                if done:
+                    await session.execute(remove, [{"b_id": retry_id, "b_attempt": attempt} for retry_id, attempt in done])
+                await session.commit()
+        except BaseException:
+            # Nothing was committed: keep the retries for the next flush, under any scheduled since
+            self._pending = {**pending, **self._pending}
+            self._done |= done
+            raise
+
+    async def claim_due(self, campaign_id: int, limit: int = RETRY_CLAIM_LIMIT) -> List[Tuple[str, int, int]]:
+        """Lease retries that are due and return (phone, attempt, row id) triples"""
+        await self.flush()
+        now = datetime.datetime.utcnow()
+        query = (
+            select(CallRetry.id, CallRetry.phone, CallRetry.attempt)
+            .where(CallRetry.campaign_id == campaign_id, CallRetry.next_attempt_at <= now)
+            .order_by(CallRetry.next_attempt_at)
+            .limit(limit)
+        )
+        async with async_session_maker() as session:
+            rows = (await session.execute(query)).all()
+            if not rows:
+                return []
+            lease = now + datetime.timedelta(seconds=RETRY_CLAIM_LEASE)
+            await session.execute(
+                update(CallRetry).where(CallRetry.id.in_([row.id for row in rows])).values(next_attempt_at=lease)
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+        return [(row.phone, row.attempt, row.id) for row in rows]
+
+    async def has_pending(self, campaign_id: int) -> bool:
+        await self.flush()
+        query = select(exists().where(CallRetry.campaign_id == campaign_id))
+        async with async_session_maker() as session:
+            return (await session.execute(query)).scalar()
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(RETRY_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Retry queue flush failed: {e}")
+
+
+retry_queue = RetryQueue()
@@ -1,9 +1,9 @@
 import datetime as dt
 import uuid
-from typing import List, Dict, Optional
+from typing import Any, List, Dict, Optional
 
 from fastapi_users import schemas
-from pydantic import BaseModel
+from pydantic import BaseModel, computed_field
 from sqlalchemy import DateTime
 
 
@@ -29,18 +29,79 @@ class SoundFileCreate(BaseModel):
 class SoundFile(SoundFileCreate):
     id: int
     user_id: int
+    status: str = "ready"
+    blob_hash: Optional[str] = None
+
+    # Versioned by the content hash, so the browser may cache them for good
+    @computed_field
+    @property
+    def audio_url(self) -> str:
+        url = f"/api/sound-files/{self.id}/audio"
+        return f"{url}?v={self.blob_hash}" if self.blob_hash else url
+
+    @computed_field
+    @property
+    def peaks_url(self) -> Optional[str]:
+        return f"/api/sound-files/{self.id}/peaks?v={self.blob_hash}" if self.blob_hash else None
+
+
+class SoundFileUpdate(BaseModel):
+    # The path is set by the server at upload and cannot be changed
+    name: str
+
+
+class SoundFileUpload(SoundFile):
+    # None when the content was uploaded before and needs no conversion
+    job_id: Optional[str] = None
 
 class PhoneListCreate(BaseModel):
-    phones: List[str]
+    phones: Optional[List[str]] = None
     name: str
     class Config:
         orm_mode = True
 
 
-class PhoneList(PhoneListCreate):
+class PhoneList(BaseModel):
     id: int
+    name: str
+    size: int
+    invalid: int = 0
     user_id: int
 
+    class Config:
+        from_attributes = True
+
+
+class PhoneNumbers(BaseModel):
+    numbers: List[str]
+
+
+class PhoneNumber(BaseModel):
+    id: int
+    number: str
+    valid: bool = True
+
+    class Config:
+        from_attributes = True
+
+
+class PhoneNumberPage(BaseModel):
+    numbers: List[PhoneNumber]
+    next_cursor: Optional[int] = None
+
+
+class JobStatus(BaseModel):
+    id: str
+    kind: str
+    status: str
+    progress: Dict[str, Any]
+    error: Optional[str] = None
+    created_at: dt.datetime
+    finished_at: Optional[dt.datetime] = None
+
+    class Config:
+        from_attributes = True
+
 
 class CompanyCreate(BaseModel):
     name: str
@@ -67,6 +128,38 @@ class CallFile(BaseModel):
     companyId: int
     filepath: str
     reaction: Dict[str, str]
+    max_retries: int = 2
+    retry_delay: int = 60
+    retry_backoff: float = 2.0
+
+
+class Campaign(BaseModel):
+    id: int
+    company_id: int
+    user_id: int
+    status: str
+    sound_file: str
+    reaction: Dict[str, str]
+    cursor: int
+    total: int
+    dialed: int
+    retried: int = 0
+    max_retries: Optional[int] = None
+    retry_delay: Optional[int] = None
+    retry_backoff: Optional[float] = None
+    error: Optional[str] = None
+    created_at: dt.datetime
+    updated_at: dt.datetime
+
+    class Config:
+        from_attributes = True
+
+
+class CampaignStats(BaseModel):
+    campaign_id: int
+    total: int
+    statuses: Dict[str, int]
+    reactions: Dict[str, int]
 
 
 class CreateEventRequest(BaseModel):
@@ -99,6 +192,7 @@ class KanbanCardResponse(BaseModel):
     task: Optional[str] = None
     datetime: Optional[dt.datetime] = None
     column_id: int
+    rank: Optional[str] = None
     user_id: Optional[List[int]] = None
 
     class Config:
@@ -112,7 +206,9 @@ class KanbanCardResponse(BaseModel):
 class KanbanColumnCreate(BaseModel):
     title: str
     tag_color: Optional[str] = None
-    position: Optional[str] = None
+    position: Optional[int] = None
+    # Visible only to its author; columns are shared by default
+    private: bool = False
     # tasks: Optional[List[KanbanCardCreate]] = None
 
     class Config:
@@ -122,9 +218,10 @@ class KanbanColumnCreate(BaseModel):
 class KanbanColumnResponse(BaseModel):
     id: int
     title: str
-    tag_color: str
-    position: int
-    tasks: List[KanbanCardResponse]
+    tag_color: Optional[str] = None
+    position: Optional[int] = None
+    rank: Optional[str] = None
+    tasks: List[KanbanCardResponse] = []
 
     class Config:
         from_attributes = True
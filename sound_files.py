@@ -0,0 +1,284 @@
+import asyncio
+import datetime
+import multiprocessing
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from pydub import AudioSegment
+from sqlalchemy import delete, or_, select, update
+from sqlalchemy.dialects.sqlite import insert
+from starlette.config import Config
+
+from db import async_session_maker
+from jobs import Job
+from models import SoundBlob, SoundFileModel
+
+config = Config('.env')
+
+SOUND_PENDING = "pending"
+SOUND_READY = "ready"
+SOUND_FAILED = "failed"
+
+SOUND_TRANSCODE_WORKERS = config('SOUND_TRANSCODE_WORKERS', cast=int, default=2)
+# A conversion still pending after this many seconds is taken to have died with its worker
+SOUND_TRANSCODE_STALE = config('SOUND_TRANSCODE_STALE', cast=float, default=1800.0)
+SOUND_UPLOAD_CHUNK = 1024 * 1024
+SOUND_ACCESS_CACHE_SIZE = 10000
+# How long a worker trusts a cached owner of a sound file that another worker may have deleted, in seconds
+SOUND_ACCESS_CACHE_TTL = config('SOUND_ACCESS_CACHE_TTL', cast=float, default=60.0)
+
+# Content-addressed store: blobs/<sha256>.wav is the transcoded audio,
+# blobs/src/<sha256><ext> the upload it was made from
+SOUND_BLOBS_DIRECTORY = "files/blobs"
+SOUND_SOURCES_DIRECTORY = f"{SOUND_BLOBS_DIRECTORY}/src"
+
+# Codec-native variants rendered next to the WAV: extension -> (ffmpeg format, extra parameters).
+# Asterisk plays the one matching the channel codec instead of transcoding the WAV per call.
+SOUND_VARIANTS = {
+    ".ulaw": ("mulaw", []),
+    ".alaw": ("alaw", []),
+    ".sln": ("s16le", []),
+    ".g722": ("g722", ["-ar", "16000"]),
+}
+
+
+# Waveform preview: one (min, max) int8 pair per SOUND_PEAKS_SAMPLES samples of the 8 kHz WAV,
+# i.e. 100 pairs (200 bytes) per second of audio
+SOUND_PEAKS_SAMPLES = 80
+
+
+def blob_path(blob_hash: str) -> str:
+    return f"{SOUND_BLOBS_DIRECTORY}/{blob_hash}.wav"
+
+
+def blob_peaks_path(blob_hash: str) -> str:
+    return f"{SOUND_BLOBS_DIRECTORY}/{blob_hash}.peaks"
+
+
+def blob_variant_paths(blob_hash: str) -> List[str]:
+    base = f"{SOUND_BLOBS_DIRECTORY}/{blob_hash}"
+    return [blob_path(blob_hash), blob_peaks_path(blob_hash)] + [base + extension for extension in SOUND_VARIANTS]
+
+
+def blob_source_path(blob_hash: str, extension: str) -> str:
+    return f"{SOUND_SOURCES_DIRECTORY}/{blob_hash}{extension}"
+
+
+def stale_before() -> datetime.datetime:
+    return datetime.datetime.utcnow() - datetime.timedelta(seconds=SOUND_TRANSCODE_STALE)
+
+
+def compute_peaks(audio: AudioSegment, samples_per_peak: int = SOUND_PEAKS_SAMPLES) -> bytes:
+    """Interleaved int8 min/max of every ``samples_per_peak`` samples of 16-bit mono audio"""
+    samples = np.frombuffer(audio.raw_data, dtype=np.int16)
+    padding = -len(samples) % samples_per_peak
+    if padding:
+        samples = np.concatenate([samples, np.zeros(padding, dtype=np.int16)])
+    blocks = samples.reshape(-1, samples_per_peak)
+    peaks = np.empty((len(blocks), 2), dtype=np.int8)
+    peaks[:, 0] = blocks.min(axis=1) >> 8
+    peaks[:, 1] = blocks.max(axis=1) >> 8
+    return peaks.tobytes()
+
+
+def render_sound(source: str, target: str):
+    """Convert any audio file ffmpeg understands to 8 kHz mono 16-bit PCM WAV,
+    plus the SOUND_VARIANTS and waveform peaks next to it.
+
+    Runs in a worker process: pydub and ffmpeg are CPU bound and blocking.
+    """
+    audio = AudioSegment.from_file(source)
+    audio = audio.set_frame_rate(8000)
+    audio = audio.set_channels(1)
+    audio.export(target, format="wav", parameters=["-acodec", "pcm_s16le"])
+    base = os.path.splitext(target)[0]
+    for extension, (fmt, parameters) in SOUND_VARIANTS.items():
+        audio.export(base + extension, format=fmt, parameters=parameters)
+    with open(base + ".peaks", "wb") as f:
+        f.write(compute_peaks(audio.set_sample_width(2)))
+
+
+async def add_blob_reference(session, blob_hash: str, extension: str, upload_path: str) -> Tuple[str, bool]:
+    """Count a new reference to the blob with this hash, creating it from ``upload_path`` if it is new.
+
+    Returns the blob status and whether it has to be transcoded: only for new
+    content, content whose earlier conversion failed, or whose conversion is
+    stale. Otherwise the upload is a duplicate and is dropped without running
+    ffmpeg.
+    """
+    now = datetime.datetime.utcnow()
+    query = insert(SoundBlob).values(hash=blob_hash, extension=extension, refcount=1, status=SOUND_PENDING,
+                                     pending_since=now)
+    query = query.on_conflict_do_update(
+        index_elements=[SoundBlob.hash],
+        set_={"refcount": SoundBlob.refcount + 1},
+    ).returning(SoundBlob.refcount, SoundBlob.status, SoundBlob.pending_since)
+    refcount, status, pending_since = (await session.execute(query)).one()
+
+    stale = status == SOUND_PENDING and (pending_since is None or pending_since < stale_before())
+    if refcount == 1 or status == SOUND_FAILED or stale:
+        await session.execute(
+            update(SoundBlob).where(SoundBlob.hash == blob_hash)
+            .values(extension=extension, status=SOUND_PENDING, pending_since=now)
+        )
+        os.replace(upload_path, blob_source_path(blob_hash, extension))
+        return SOUND_PENDING, True
+    os.remove(upload_path)
+    return status, False
+
+
+async def release_blob_reference(session, blob_hash: str):
+    """Drop one reference to a blob; its files are deleted with the last one"""
+    query = (
+        update(SoundBlob).where(SoundBlob.hash == blob_hash)
+        .values(refcount=SoundBlob.refcount - 1)
+        .returning(SoundBlob.refcount, SoundBlob.extension)
+    )
+    row = (await session.execute(query)).first()
+    if row is None or row.refcount > 0:
+        return
+    await session.execute(delete(SoundBlob).where(SoundBlob.hash == blob_hash))
+    remove_blob_outputs(blob_hash)
+    source = blob_source_path(blob_hash, row.extension)
+    if os.path.exists(source):
+        os.remove(source)
+
+
+def remove_blob_outputs(blob_hash: str):
+    """Delete the WAV, variants and peaks rendered for a blob, including partial ones"""
+    for path in blob_variant_paths(blob_hash):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class SoundAccess(NamedTuple):
+    user_id: int
+    file_path: str
+    blob_hash: Optional[str]
+
+
+class SoundAccessCache:
+    """Owner and path of ready sound files, so serving audio mostly needs no database query.
+
+    Only ready files are cached. Every worker has its own cache and only
+    drops entries of the files it updates or deletes itself, so a hit is
+    checked before it is used: an entry older than SOUND_ACCESS_CACHE_TTL,
+    of another owner (the id may have been reused) or whose blob is gone is
+    looked up again in the database.
+    """
+
+    def __init__(self, size: int = SOUND_ACCESS_CACHE_SIZE, ttl: float = SOUND_ACCESS_CACHE_TTL):
+        self._size = size
+        self._ttl = ttl
+        self._entries: "OrderedDict[int, Tuple[SoundAccess, float]]" = OrderedDict()
+
+    async def get(self, session, sound_file_id: int, user_id: int) -> Optional[SoundAccess]:
+        entry = self._entries.get(sound_file_id)
+        if entry is not None:
+            access, expires = entry
+            if expires > time.monotonic() and access.user_id == user_id and self._exists(access):
+                self._entries.move_to_end(sound_file_id)
+                return access
+            del self._entries[sound_file_id]
+        sound_file = await session.get(SoundFileModel, sound_file_id)
+        if sound_file is None or sound_file.status != SOUND_READY:
+            return None
+        access = SoundAccess(sound_file.user_id, sound_file.file_path, sound_file.blob_hash)
+        self._entries[sound_file_id] = (access, time.monotonic() + self._ttl)
+        if len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+        return access
+
+    @staticmethod
+    def _exists(access: SoundAccess) -> bool:
+        # Files from before the blob store are checked by the endpoint
+        return access.blob_hash is None or os.path.exists(blob_path(access.blob_hash))
+
+    def forget(self, sound_file_id: int):
+        self._entries.pop(sound_file_id, None)
+
+
+class Transcoder:
+    """Process pool running sound-file conversions off the event loop"""
+
+    def __init__(self):
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn: forking a process that runs an event loop and database threads is unsafe
+            self._pool = ProcessPoolExecutor(SOUND_TRANSCODE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    def _drop_pool(self, pool: ProcessPoolExecutor):
+        """Forget a pool broken by a worker that died (e.g. killed by the OOM killer); the next job starts a new one"""
+        if self._pool is pool:
+            self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    async def transcode(self, job: Job, blob_hash: str, extension: str):
+        """Convert a blob's source and mark it, and every sound file using it, ready (or failed).
+
+        A job caught in a pool broken by another conversion is retried once in
+        a new pool. The outputs of a failed conversion are deleted, and so are
+        those of a blob released while it was being converted.
+        """
+        job.progress["blob_hash"] = blob_hash
+        status = SOUND_FAILED
+        try:
+            for attempt in range(2):
+                pool = self.pool
+                try:
+                    await asyncio.get_running_loop().run_in_executor(
+                        pool, render_sound, blob_source_path(blob_hash, extension), blob_path(blob_hash)
+                    )
+                    break
+                except BrokenProcessPool:
+                    self._drop_pool(pool)
+                    if attempt:
+                        raise
+            status = SOUND_READY
+        finally:
+            if not await self._set_status(blob_hash, status) or status == SOUND_FAILED:
+                remove_blob_outputs(blob_hash)
+
+    async def _set_status(self, blob_hash: str, status: str) -> bool:
+        """Set the status of a blob and its sound files; False if the blob no longer exists"""
+        async with async_session_maker() as session:
+            result = await session.execute(update(SoundBlob).where(SoundBlob.hash == blob_hash).values(status=status))
+            await session.execute(
+                update(SoundFileModel).where(SoundFileModel.blob_hash == blob_hash).values(status=status)
+            )
+            await session.commit()
+        return result.rowcount == 1
+
+    async def restore(self):
+        """Mark conversions that died with their worker failed; uploading the file again retries them.
+
+        Only conversions pending for longer than SOUND_TRANSCODE_STALE count:
+        younger ones may still be running in another worker.
+        """
+        async with async_session_maker() as session:
+            query = select(SoundBlob.hash).where(
+                SoundBlob.status == SOUND_PENDING,
+                or_(SoundBlob.pending_since.is_(None), SoundBlob.pending_since < stale_before()),
+            )
+            pending = (await session.execute(query)).scalars().all()
+        for blob_hash in pending:
+            await self._set_status(blob_hash, SOUND_FAILED)
+            remove_blob_outputs(blob_hash)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+transcoder = Transcoder()
+sound_access = SoundAccessCache()
@@ -0,0 +1,69 @@
+import asyncio
+
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from kanban import _create_kanban_search, phone_digits, search_cards, search_query
+from models import Base, KanbanCard, KanbanColumn
+
+
+def test_phone_digits_splits_numbers():
+    assert phone_digits("+7‒701‒260‒00‒02, +7‒778‒888‒84‒04") == "77012600002 77788888404"
+    assert phone_digits("8 (747) 901-01-93; +7 701 260 00 02") == "87479010193 77012600002"
+    assert phone_digits("+7‒701‒260‒00‒02,") == "77012600002"
+    assert phone_digits("") is None
+    assert phone_digits(None) is None
+    assert phone_digits("нет") is None
+
+
+def test_search_query_phone():
+    assert search_query("+7 701 260") == 'phone : "7701260"*'
+    assert search_query("+7‒701‒260‒00‒02") == 'phone : "77012600002"*'
+    assert search_query("7701260") == '"7701260"* OR phone : "7701260"*'
+    assert search_query("+77012600002") == '"77012600002"* OR phone : "77012600002"*'
+
+
+def test_search_query_words():
+    assert search_query("Иванов acme") == '"Иванов"* AND "acme"*'
+    assert search_query("---") is None
+
+
+async def _search_after_changes(url):
+    engine = create_async_engine(url)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_create_kanban_search)
+    found = {}
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        async def search(query, column_id=None):
+            return [card.id for card in await search_cards(session, None, query, column_id)]
+
+        session.add_all([KanbanColumn(id=1, title="first", rank="a"), KanbanColumn(id=2, title="second", rank="b")])
+        card = KanbanCard(id="card", name="Иванов", company="Acme", phone="+7 701 260-00-02", column_id=1, rank="a")
+        session.add(card)
+        await session.commit()
+        found["insert"] = await search("иванов"), await search("acme"), await search("+7 701 260")
+
+        card.name = "Петров"
+        card.phone = "8 (747) 901-01-93"
+        await session.commit()
+        found["update"] = await search("иванов"), await search("петров"), await search("7701260"), await search("8747")
+
+        card.column_id = 2
+        await session.commit()
+        found["move"] = await search("петров", 1), await search("петров", 2)
+
+        await session.delete(card)
+        await session.commit()
+        found["delete"] = await search("петров"), await search("acme")
+    await engine.dispose()
+    return found
+
+
+def test_search_index_follows_insert_update_move_and_delete(tmp_path):
+    found = asyncio.run(_search_after_changes(f"sqlite+aiosqlite:///{tmp_path / 'kanban.db'}"))
+    assert found == {
+        "insert": (["card"], ["card"], ["card"]),
+        "update": ([], ["card"], [], ["card"]),
+        "move": ([], ["card"]),
+        "delete": ([], []),
+    }
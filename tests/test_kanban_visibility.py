@@ -0,0 +1,52 @@
+import asyncio
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from kanban import _create_kanban_search, allowed_topics, card_topics, card_visible, page_cards, search_cards
+from models import Base, KanbanCard, KanbanColumn, user_kanban_card_associacion
+
+
+async def _check_visibility(url):
+    engine = create_async_engine(url)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_create_kanban_search)
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        session.add_all([
+            KanbanColumn(id=1, title="shared", rank="a"),
+            KanbanColumn(id=2, title="private of 1", rank="b", user_id=1),
+            KanbanColumn(id=3, title="private of 2", rank="c", user_id=2),
+        ])
+        cards = [
+            KanbanCard(id="shared", name="Acme shared", column_id=1, rank="a"),
+            KanbanCard(id="own", name="Acme own", column_id=2, rank="a"),
+            KanbanCard(id="assigned", name="Acme assigned", column_id=2, rank="b"),
+            KanbanCard(id="other", name="Acme other", column_id=3, rank="a"),
+        ]
+        session.add_all(cards)
+        await session.flush()
+        await session.execute(insert(user_kanban_card_associacion).values(user_id=2, kanban_card_id="assigned"))
+        await session.commit()
+
+        visible = {}
+        for user_id in (None, 1, 2, 3):
+            paged = {card.id for card in await page_cards(session, user_id)}
+            found = {card.id for card in await search_cards(session, user_id, "acme")}
+            for card in cards:
+                events = bool(await card_topics(session, card) & allowed_topics(user_id))
+                # Events, paging, search and mutations agree on every card
+                assert events == (card.id in paged) == (card.id in found) == await card_visible(session, user_id, card)
+            visible[user_id] = paged
+    await engine.dispose()
+    return visible
+
+
+def test_one_visibility_rule_for_events_paging_search_and_mutations(tmp_path):
+    visible = asyncio.run(_check_visibility(f"sqlite+aiosqlite:///{tmp_path / 'kanban.db'}"))
+    assert visible == {
+        None: {"shared"},
+        1: {"shared", "own", "assigned"},
+        2: {"shared", "assigned", "other"},
+        3: {"shared"},
+    }
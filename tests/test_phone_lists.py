@@ -0,0 +1,79 @@
+import json
+import os
+import shutil
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from db import add_missing_columns
+from models import Base
+from phone_lists import _legacy_numbers, _migrate_json_phone_lists, _revalidate_numbers
+from phones import normalize_phone
+
+TEST_DB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test.db")
+
+
+def test_legacy_numbers_keep_invalid_values():
+    numbers, invalid = _legacy_numbers(["89991234567", " 7702830", "+79991234567", "", None, "7702830"])
+    assert numbers == ["+79991234567"]
+    assert invalid == ["7702830"]
+
+
+def test_invalid_numbers_pass_once_the_rules_accept_them():
+    engine = create_engine("sqlite://")
+    with engine.begin() as conn:
+        Base.metadata.create_all(conn)
+        conn.execute(text("INSERT INTO phones (id, name, size, invalid) VALUES (1, 'list', 1, 2)"))
+        conn.execute(text(
+            "INSERT INTO phone_numbers (list_id, number, valid) VALUES"
+            " (1, '+79991234567', 1), (1, '89991234567', 0), (1, '89990000000', 0), (1, '7702830', 0)"
+        ))
+        _revalidate_numbers(conn)
+        rows = conn.execute(text("SELECT number, valid FROM phone_numbers ORDER BY id")).all()
+        assert [tuple(row) for row in rows] == [("+79991234567", 1), ("+79990000000", 1), ("7702830", 0)]
+        assert tuple(conn.execute(text("SELECT size, invalid FROM phones")).one()) == (2, 1)
+    engine.dispose()
+
+
+@pytest.mark.skipif(not os.path.exists(TEST_DB), reason="no test.db")
+def test_migration_moves_every_number(tmp_path):
+    path = tmp_path / "test.db"
+    shutil.copy(TEST_DB, path)
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.begin() as conn:
+        if "phones" not in {row[1] for row in conn.execute(text("PRAGMA table_info(phones)"))}:
+            pytest.skip("test.db has no JSON phone lists")
+        lists = {
+            list_id: json.loads(phones)
+            for list_id, phones in conn.execute(text("SELECT id, phones FROM phones WHERE phones IS NOT NULL"))
+        }
+        Base.metadata.create_all(conn)
+        add_missing_columns(conn)
+        _migrate_json_phone_lists(conn)
+        # Running again changes nothing
+        _migrate_json_phone_lists(conn)
+
+    with engine.connect() as conn:
+        for list_id, raws in lists.items():
+            rows = conn.execute(
+                text("SELECT number, valid FROM phone_numbers WHERE list_id = :id ORDER BY id"), {"id": list_id}
+            ).all()
+            numbers = [number for number, valid in rows if valid]
+            invalid = [number for number, valid in rows if not valid]
+            assert (numbers, invalid) == _legacy_numbers(raws)
+            for raw in raws:
+                number = normalize_phone(str(raw).strip())
+                if number is None:
+                    assert not str(raw).strip() or str(raw).strip() in invalid
+                else:
+                    assert number in numbers
+            size, invalid_size, phones = conn.execute(
+                text("SELECT size, invalid, phones FROM phones WHERE id = :id"), {"id": list_id}
+            ).one()
+            assert (size, invalid_size) == (len(numbers), len(invalid))
+            assert phones is None
+            backup = conn.execute(
+                text("SELECT phones FROM phones_json_backup WHERE list_id = :id"), {"id": list_id}
+            ).scalar()
+            assert json.loads(backup) == raws
+    engine.dispose()
@@ -0,0 +1,69 @@
+import pytest
+
+from phones import dial_endpoint, normalize_phone, normalize_phones
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ("+79991234567", "+79991234567"),
+    ("89991234567", "+79991234567"),
+    ("9991234567", "+79991234567"),
+    ("79991234567", "+79991234567"),
+    ("8 (999) 123-45-67", "+79991234567"),
+    ("+7 (999) 123.45.67", "+79991234567"),
+    ("+7‒701‒260‒00‒02", "+77012600002"),
+    ("+7 701 260 00 02", "+77012600002"),
+    (" +7 999 123 45 67 ", "+79991234567"),
+    ("+44 20 7946 0958", "+442079460958"),
+    ("0044 20 7946 0958", "+442079460958"),
+    (79991234567, "+79991234567"),
+])
+def test_valid(raw, expected):
+    assert normalize_phone(raw) == expected
+
+
+@pytest.mark.parametrize("raw", [
+    "",
+    "abc",
+    # Local numbers without an area code
+    "7702830",
+    "+7702830",
+    # Extensions are not part of the number
+    "89991234567 доб. 12",
+    "+7 999 123 45 67 ext 5",
+    "89991234567#1",
+    "89991234567,12",
+    # Several numbers in one cell
+    "89991234567\n89997654321",
+    "89991234567 89997654321",
+    # Wrong length for +7
+    "+7999123456",
+    "+799912345678",
+    # Country codes never start with 0
+    "+0123456789",
+    # Longer than E.164 allows
+    "+1234567890123456",
+])
+def test_invalid(raw):
+    assert normalize_phone(raw) is None
+
+
+def test_batch_keeps_positions():
+    raws = ["89991234567", "доб. 5", "", "+442079460958", "7702830", "9991234567"]
+    assert normalize_phones(raws) == ["+79991234567", None, None, "+442079460958", None, "+79991234567"]
+
+
+def test_line_breaks_do_not_shift_the_batch():
+    assert normalize_phones(["8999\n1234567", "89991234567"]) == [None, "+79991234567"]
+
+
+@pytest.mark.parametrize("dial_format, expected", [
+    ("PJSIP/{digits}", "PJSIP/79991234567"),
+    ("PJSIP/{number}", "PJSIP/+79991234567"),
+    ("PJSIP/{national}@trunk", "PJSIP/89991234567@trunk"),
+])
+def test_dial_endpoint(dial_format, expected):
+    assert dial_endpoint("+79991234567", dial_format) == expected
+
+
+def test_dial_endpoint_national_keeps_other_countries_international():
+    assert dial_endpoint("+442071234567", "PJSIP/{national}") == "PJSIP/442071234567"
@@ -0,0 +1,75 @@
+import asyncio
+
+import pubsub
+from pubsub import RedisBroker
+
+
+class FakePubSub:
+    def __init__(self, client):
+        self.client = client
+        self.closed = False
+
+    async def subscribe(self, channel):
+        self.client.subscriptions.append(channel)
+
+    async def listen(self):
+        yield {"type": "subscribe", "data": 1}
+        while True:
+            message = await self.client.messages.get()
+            if isinstance(message, Exception):
+                raise message
+            yield {"type": "message", "data": message}
+
+    async def aclose(self):
+        self.closed = True
+
+
+class FakeRedis:
+    """The part of the redis.asyncio client RedisBroker uses; messages are what the server would deliver"""
+
+    def __init__(self):
+        self.published = []
+        self.subscriptions = []
+        self.pubsubs = []
+        self.messages = asyncio.Queue()
+
+    async def publish(self, channel, data):
+        self.published.append((channel, data))
+
+    def pubsub(self):
+        self.pubsubs.append(FakePubSub(self))
+        return self.pubsubs[-1]
+
+
+async def _exchange():
+    client = FakeRedis()
+    broker = RedisBroker(channel="kanban", client=client)
+    delivered = asyncio.Queue()
+
+    async def deliver(topics, frame):
+        await delivered.put((list(topics), frame))
+
+    await broker.start(deliver)
+    await broker.publish(["board:public", "user:1"], '{"action": "x"}')
+    # Its own message comes back from the server and is skipped, another worker's is delivered
+    await client.messages.put(client.published[0][1].encode())
+    await client.messages.put(b'other board:public\n{"action": "y"}')
+    first = await asyncio.wait_for(delivered.get(), 1)
+
+    # The connection drops: the broker subscribes again and keeps delivering
+    await client.messages.put(ConnectionError("lost"))
+    await client.messages.put('other user:2\n{"action": "z"}')
+    second = await asyncio.wait_for(delivered.get(), 1)
+    await broker.stop()
+    return client, first, second
+
+
+def test_redis_broker_publishes_delivers_and_reconnects(monkeypatch):
+    monkeypatch.setattr(pubsub, "BROKER_RECONNECT_DELAY", 0)
+    client, first, second = asyncio.run(_exchange())
+    assert client.published[0][0] == "kanban"
+    assert client.published[0][1].endswith(' board:public,user:1\n{"action": "x"}')
+    assert first == (["board:public"], '{"action": "y"}')
+    assert second == (["user:2"], '{"action": "z"}')
+    assert client.subscriptions == ["kanban", "kanban"]
+    assert all(connection.closed for connection in client.pubsubs)
@@ -0,0 +1,69 @@
+import random
+
+import pytest
+
+from ranks import rank_between, spread_ranks
+
+
+def assert_valid(keys):
+    assert keys == sorted(keys)
+    assert len(set(keys)) == len(keys)
+    assert not any(key.endswith("0") for key in keys)
+
+
+def test_appends_and_prepends_stay_ordered():
+    keys = [rank_between()]
+    for _ in range(200):
+        keys.append(rank_between(keys[-1], None))
+        keys.insert(0, rank_between(None, keys[0]))
+    assert_valid(keys)
+
+
+def test_appends_grow_keys_slowly():
+    key = rank_between()
+    for _ in range(100):
+        key = rank_between(key, None)
+    assert len(key) <= 7
+
+
+def test_random_inserts_stay_ordered():
+    rng = random.Random(0)
+    keys = []
+    for _ in range(2000):
+        i = rng.randint(0, len(keys))
+        before = keys[i - 1] if i > 0 else None
+        after = keys[i] if i < len(keys) else None
+        key = rank_between(before, after)
+        assert (before is None or before < key) and (after is None or key < after)
+        keys.insert(i, key)
+    assert_valid(keys)
+
+
+def test_adjacent_keys_have_a_key_between():
+    before, after = "i", "i1"
+    for _ in range(50):
+        key = rank_between(before, after)
+        assert before < key < after
+        assert not key.endswith("0")
+        after = key
+
+
+def test_rank_between_rejects_unordered_bounds():
+    with pytest.raises(ValueError):
+        rank_between("b", "a")
+    with pytest.raises(ValueError):
+        rank_between("a", "a")
+
+
+@pytest.mark.parametrize("count", [0, 1, 2, 5, 36, 100, 5000])
+def test_spread_ranks(count):
+    keys = spread_ranks(count)
+    assert len(keys) == count
+    assert_valid(keys)
+    if keys:
+        width = max(len(key) for key in keys)
+        # Room at both ends and between neighbours without growing the keys
+        assert len(rank_between(None, keys[0])) <= width
+        assert len(rank_between(keys[-1], None)) <= width
+        for before, after in zip(keys, keys[1:]):
+            assert len(rank_between(before, after)) <= width
@@ -0,0 +1,48 @@
+import asyncio
+
+import sound_files
+from models import SoundFileModel
+from sound_files import SOUND_READY, SoundAccessCache
+
+
+class FakeSession:
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = 0
+
+    async def get(self, model, key):
+        self.queries += 1
+        return self.rows.get(key)
+
+
+def test_cache_checks_hits_another_worker_may_have_made_stale(tmp_path, monkeypatch):
+    monkeypatch.setattr(sound_files, "SOUND_BLOBS_DIRECTORY", str(tmp_path))
+    (tmp_path / "abc.wav").write_bytes(b"")
+    session = FakeSession({1: SoundFileModel(id=1, user_id=1, file_path="x", status=SOUND_READY, blob_hash="abc")})
+    cache = SoundAccessCache()
+
+    async def get(user_id):
+        return await cache.get(session, 1, user_id)
+
+    assert asyncio.run(get(1)).user_id == 1
+    assert asyncio.run(get(1)).user_id == 1
+    assert session.queries == 1
+
+    # The id was reused for a file of user 2 by another worker
+    session.rows[1] = SoundFileModel(id=1, user_id=2, file_path="y", status=SOUND_READY, blob_hash="abc")
+    assert asyncio.run(get(2)).user_id == 2
+    assert session.queries == 2
+
+    # The blob was deleted by another worker
+    (tmp_path / "abc.wav").unlink()
+    del session.rows[1]
+    assert asyncio.run(get(2)) is None
+    assert session.queries == 3
+
+
+def test_cache_entries_expire():
+    session = FakeSession({1: SoundFileModel(id=1, user_id=1, file_path="x", status=SOUND_READY)})
+    cache = SoundAccessCache(ttl=0)
+    asyncio.run(cache.get(session, 1, 1))
+    asyncio.run(cache.get(session, 1, 1))
+    assert session.queries == 2
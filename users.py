@@ -2,7 +2,8 @@ import contextlib
 import uuid
 from typing import Optional
 
-from fastapi import Depends, Request
+import jwt
+from fastapi import Depends, HTTPException, Request
 from fastapi_users import BaseUserManager, FastAPIUsers, UUIDIDMixin, IntegerIDMixin
 from fastapi_users.authentication import (
     AuthenticationBackend,
@@ -13,6 +14,7 @@ from fastapi_users.authentication import (
 
 from fastapi_users.db import SQLAlchemyUserDatabase
 from fastapi_users.exceptions import UserAlreadyExists
+from fastapi_users.jwt import decode_jwt
 from sqlalchemy import select
 from starlette.config import Config
 from httpx_oauth.clients.google import GoogleOAuth2
@@ -20,6 +22,7 @@ from httpx_oauth.clients.github import GitHubOAuth2
 from httpx_oauth.clients.openid import OpenID
 
 from db import get_async_session, get_user_db
+from phone_lists import add_numbers, split_numbers
 from models import CompanyModel, PhoneListModel, SoundFileModel, User
 from schemas import UserCreate
 
@@ -89,6 +92,22 @@ fastapi_users = FastAPIUsers[User, int](get_user_manager, [auth_backend])
 
 current_active_user = fastapi_users.current_user(active=True)
 
+
+async def current_token_user_id(token: Optional[str] = Depends(bearer_transport.scheme)) -> int:
+    """Id of the user a valid JWT was issued to, without loading the user from the database.
+
+    For hot read-only routes such as audio range requests: a user deactivated
+    after login keeps this access until the token expires.
+    """
+    if token is None:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    strategy = get_jwt_strategy()
+    try:
+        data = decode_jwt(token, strategy.decode_key, strategy.token_audience, algorithms=[strategy.algorithm])
+        return int(data["sub"])
+    except (jwt.PyJWTError, KeyError, ValueError):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
 get_async_session_context = contextlib.asynccontextmanager(get_async_session)
 get_user_db_context = contextlib.asynccontextmanager(get_user_db)
 get_user_manager_context = contextlib.asynccontextmanager(get_user_manager)
@@ -109,6 +128,17 @@ async def create_user_pro(email: str, password: str, is_superuser: bool = False)
         print(f"User {email} already exists")
 
 
+async def get_user_from_token(token: str) -> Optional[User]:
+    """Active user of a JWT issued by auth_backend, for connections that cannot use the Bearer header"""
+    async with get_async_session_context() as session:
+        async with get_user_db_context(session) as user_db:
+            async with get_user_manager_context(user_db) as user_manager:
+                user = await get_jwt_strategy().read_token(token, user_manager)
+    if user is None or not user.is_active:
+        return None
+    return user
+
+
 async def get_all_users():
     async with get_async_session_context() as session:
         async with session.begin():
@@ -138,7 +168,13 @@ async def create_sound_file_pro(name: str, file_path: str, user_id: int):
 
 async def create_phone_list_pro(name: str, phones, user_id: int):
     async with get_async_session_context() as session:
-        phone_list = PhoneListModel(name=name, phones=phones, user_id=user_id)
+        phone_list = PhoneListModel(name=name, user_id=user_id)
         session.add(phone_list)
+        await session.flush()
+        numbers, invalid = split_numbers(phones)
+        await add_numbers(session, phone_list.id, numbers)
         await session.commit()
         print(f"PhoneList created {phone_list}")
+        if invalid:
+            print(f"PhoneList {phone_list.id}: {len(invalid)} numbers failed validation and were not added: {invalid[:10]}")
+        return phone_list, invalid